@@ -79,12 +79,12 @@ Now since the state space is continuous, any method– either discretization or
 learning_policy_progress = tqdm(total=500)
 trajectory_progress = tqdm(total=5000)
 
-from dqn import DQNPolicy, ReplayBuffer
+from dqn import TorchDQNPolicy, ReplayBuffer
 def do_q_learning(env, reward_function, train_episodes, figure=False):
     alpha = 0.01
     gamma = 0.9
     epsilon = 0.1
-    policy = DQNPolicy(env, lr=alpha, gamma=gamma, input=2, output=4)  # 4 actions output, up, right, down, left
+    policy = TorchDQNPolicy(env, lr=alpha, gamma=gamma, input=2, output=4)  # 4 actions output, up, right, down, left
     replay_buffer = ReplayBuffer()
     # Play with a random policy and see
     # run_current_policy(env.env, policy)
@@ -138,7 +138,8 @@ def do_q_learning(env, reward_function, train_episodes, figure=False):
         plt.xlabel('Episode')
         plt.ylabel('Reward')
         plt.show()
-    return policy.q_model
+    # the policy predicts Q(state, a) for all actions a, just like the keras model did
+    return policy
 
 # In[]:
 
@@ -155,7 +156,7 @@ true_policy = do_q_learning(env, true_reward_function, 500, figure=True)
 all_policies = list()
 gamma = 0.9
 # form a random policy for now
-# cur_policy = DQNPolicy(env, 0.01, 0.9, input=2, output=4)
+# cur_policy = TorchDQNPolicy(env, 0.01, 0.9, input=2, output=4)
 cur_policy = true_policy
 each_episode_length = 30
 env = Agent()
@@ -205,7 +206,7 @@ def run_trajectories(cur_policy):
 
 true_values_per_basis = run_trajectories(true_policy) # it is the value of state(0,0) as per the best policy
 # true_values_per_basis is a (225,) vector
-policy = DQNPolicy(env, 0.01, 0.9, input=2, output=4).q_model
+policy = TorchDQNPolicy(env, 0.01, 0.9, input=2, output=4)
 
 # In[]:
 
@@ -4,6 +4,7 @@
 # take the action that maximizes the utility of that state
 import numpy as np
 from gridworld import GridWorld
+from return_functions import discounted_returns, first_return
 
 
 def get_return(state_list, gamma):
@@ -12,13 +13,7 @@ def get_return(state_list, gamma):
     :param gamma: the discount factor
     :return: the return value for that state_list
     """
-    return_value = 0
-    counter = 0
-    for visit in state_list:
-        reward = visit[2]
-        return_value += reward * np.power(gamma, counter)
-        counter += 1
-    return return_value
+    return first_return([visit[2] for visit in state_list], gamma)
 
 
 def print_policy(p, shape):
@@ -117,6 +112,8 @@ for epoch in range(n_epochs):
             break
     # This cycle is the implementation of First-Visit MC.
     first_visit_done = np.zeros((4, 12))
+    # the returns of all the timesteps of the episode in one reverse pass
+    returns = discounted_returns([visit[2] for visit in episode_list], gamma)
     counter = 0
     # For each state-action stored in the episode list it checks if
     # it is the first visit and then estimates the return.
@@ -127,7 +124,7 @@ for epoch in range(n_epochs):
         column = observation[0] * 4 + observation[1]
         row = int(action)
         if first_visit_done[row, column] == 0:
-            return_value = get_return(episode_list[counter:], gamma)
+            return_value = returns[counter]
             running_mean_matrix[row, column] += 1
             Q[row, column] += return_value
             first_visit_done[row, column] = 1
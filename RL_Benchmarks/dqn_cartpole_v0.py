@@ -2,7 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm.autonotebook import tqdm
 import gym
-from dqn import DQNPolicy, ReplayBuffer
+from dqn import TorchDQNPolicy, ReplayBuffer, PrioritizedReplayBuffer, PrefetchSampler
 from plot_functions import plot_timesteps_and_rewards
 
 # In[]:
@@ -37,8 +37,17 @@ avg_reward = 0.0
 avg_timestep = 0
 
 # initialize policy and replay buffer
-cp_policy = DQNPolicy(cp_env, lr=cp_alpha, gamma=cp_gamma)
-replay_buffer = ReplayBuffer()
+cp_policy = TorchDQNPolicy(cp_env, lr=cp_alpha, gamma=cp_gamma)
+# replay the transitions with a high TD error more often
+prioritized_replay = False
+# bootstrap the TD targets n_step steps ahead
+n_step = 1
+if prioritized_replay:
+    replay_buffer = PrioritizedReplayBuffer(n_step=n_step, gamma=cp_gamma)
+else:
+    replay_buffer = ReplayBuffer(n_step=n_step, gamma=cp_gamma)
+# draw the next batches on a background thread while the networks are being updated
+sampler = PrefetchSampler(replay_buffer, sample_size=32, prefetch=4, pytorch=False)
 cp_start_episode = 0
 
 # Play with a random policy and see
@@ -66,14 +75,19 @@ for episode_i in range(cp_start_episode, cp_start_episode + cp_train_episodes):
         next_state, reward, done, info = cp_env.step(action)
 
         # add the transition to replay buffer
-        replay_buffer.add(cur_state, action, next_state, reward, done)
+        sampler.add(cur_state, action, next_state, reward, done)
 
         # sample minibatch of transitions from the replay buffer
         # the sampling is done every timestep and not every episode
-        sample_transitions = replay_buffer.sample()
+        # with n-step returns nothing is stored during the first n-1 steps of the run
+        if len(replay_buffer) > 0:
+            sample_transitions = sampler.sample()
+            indices = sample_transitions.pop('indices', None)
 
-        # update the policy using the sampled transitions
-        cp_policy.update_policy(**sample_transitions)
+            # update the policy using the sampled transitions
+            td_errors = cp_policy.update_policy(**sample_transitions)
+            if prioritized_replay:
+                sampler.update_priorities(indices, td_errors)
 
         episode_reward += reward
         episode_timestep += 1
@@ -92,6 +106,7 @@ for episode_i in range(cp_start_episode, cp_start_episode + cp_train_episodes):
 
     pbar_cp.update()
 cp_start_episode = cp_start_episode + cp_train_episodes
+sampler.close()
 plot_timesteps_and_rewards(cp_avg_history)
 run_current_policy(cp_env, cp_policy, cp_epsilon)
 cp_env.close()
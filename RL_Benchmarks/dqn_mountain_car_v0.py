@@ -1,4 +1,5 @@
 from dqn import DQNPolicy, ReplayBuffer
+from checkpoint import CheckpointWriter, checkpoint_exists, load_checkpoint
 import gym
 
 
@@ -42,7 +43,22 @@ total_train_episodes = 500
 # In[]:
 history = dict({'reward':list(), 'timesteps':list(), 'episodes':list()})
 
-for episode in range(total_train_episodes):
+# checkpoint the run every checkpoint_interval episodes
+checkpoint_dir = 'checkpoints/dqn_mountain_car'
+# continue the run of the last checkpoint, e.g. after it was killed, instead of starting a new one which overwrites it
+resume = False
+checkpoint_interval = 50
+checkpoint_writer = CheckpointWriter(checkpoint_dir)
+start_episode = 0
+if resume and checkpoint_exists(checkpoint_dir):
+    # through the policy, so that the numpy snapshot it acts with is refreshed as well
+    histories = load_checkpoint(checkpoint_dir, replay_buffer, modules={'q_model': env_policy},
+                                optimizers={'q_model': env_policy.q_model.optimizer})
+    history = histories['history']
+    epsilon = histories['epsilon']
+    start_episode = len(history['episodes'])
+
+for episode in range(start_episode, total_train_episodes):
     done = False
     # print('Epoch :', episode + 1)
     ep_reward = 0
@@ -87,6 +103,12 @@ for episode in range(total_train_episodes):
     # decay the epsilon after every episode
     epsilon -= epsilon_decay
 
+    if (episode + 1) % checkpoint_interval == 0:
+        checkpoint_writer.save(replay_buffer, modules={'q_model': env_policy},
+                               optimizers={'q_model': env_policy.q_model.optimizer},
+                               histories={'history': history, 'epsilon': epsilon})
+checkpoint_writer.close()
+
 # In[]:
 
 # Now play again
@@ -1,11 +1,13 @@
 import torch
 import torch.optim as optim
 import gym
-from dqn import ReplayBuffer
+from dqn import TorchReplayBuffer, PrioritizedReplayBuffer, PrefetchSampler
 from torch.nn.functional import mse_loss
 import numpy as np
 from torch.optim.lr_scheduler import StepLR
-from actor_critic_structure import Actor, Critic
+from actor_critic_structure import Actor, Critic, EpisodeBuffer
+from numpy_inference import NumpyMLP
+from cartpole_rendering import CartPoleRasterizer, FrameWriter
 from copy import deepcopy
 
 
@@ -41,24 +43,41 @@ running_loss2_mean = 0
 loss1_history = []
 loss2_history = []
 # initialize policy and replay buffer
-replay_buffer = ReplayBuffer()
+# replay the transitions with a high TD error more often
+prioritized_replay = False
+# bootstrap the TD targets n_step steps ahead
+n_step = 1
+if prioritized_replay:
+    replay_buffer = PrioritizedReplayBuffer(n_step=n_step, gamma=gamma)
+else:
+    replay_buffer = TorchReplayBuffer(n_step=n_step, gamma=gamma)
+# draw the next batches on a background thread while the networks are being updated
+sampler = PrefetchSampler(replay_buffer, sample_size=32, prefetch=4, pytorch=True)
+# per episode storage of the transitions, grown if an episode is longer
+episode = EpisodeBuffer(max_episode_len=200)
 
 
 # In[]:
 
 
-def update_critic(cur_states, actions, next_states, rewards, dones):
+def update_critic(cur_states, actions, next_states, rewards, dones, weights=None, gammas=None):
 
+    # n-step transitions carry their own discount gamma^n, one step transitions use gamma
+    discounts = gamma if gammas is None else gammas
     # target doesnt change when its terminal, thus multiply with (1-done)
-    targets = rewards + torch.mul(1 - dones, gamma*critic(next_states).squeeze(-1) )
+    targets = rewards + torch.mul(1 - dones, discounts*critic(next_states).squeeze(-1) )
     # expanded_targets are the Q values of all the actions for the current_states sampled
     # from the previous experience. These are the predictions
     expanded_targets = critic(cur_states).squeeze(-1)
     critic_optimizer.zero_grad()
-    loss1 = mse_loss(input=expanded_targets, target=targets)
+    if weights is None:
+        loss1 = mse_loss(input=expanded_targets, target=targets)
+    else:
+        # importance sampling weights undo the bias of sampling by priority
+        loss1 = torch.mean(weights * torch.pow(targets - expanded_targets, 2))
     loss1.backward()
     critic_optimizer.step()
-    return loss1.item()
+    return loss1.item(), (targets - expanded_targets).detach()
 
 
 # In[]:
@@ -72,12 +91,13 @@ for episode_i in range(train_episodes):
     done = False
     cur_state = torch.Tensor(env.reset())
 
-    log_prob_list = torch.Tensor()
-    u_value_list = torch.Tensor()
-    target_list = torch.Tensor()
+    episode.reset()
 
     while not done:
-        action, log_prob = actor.select_action(cur_state)
+        # the actor only learns at the end of the episode, so act without a graph and recompute the log
+        # probabilities of the whole episode there in one batched forward pass
+        with torch.inference_mode():
+            action, _ = actor.select_action(cur_state)
 
         # take action in the environment
         next_state, reward, done, info = env.step(action.item())
@@ -94,21 +114,28 @@ for episode_i in range(train_episodes):
         u_value = critic(cur_state)
         target = reward + gamma * (1-done) * critic(next_state)
 
-        replay_buffer.add(cur_state, action, next_state, reward, done)
+        sampler.add(cur_state, action, next_state, reward, done)
         # sample minibatch of transitions from the replay buffer
         # the sampling is done every timestep and not every episode
-        sample_transitions = replay_buffer.sample_pytorch()
-        # update the critic's q approximation using the sampled transitions
-        running_loss1_mean += update_critic(**sample_transitions)
-
-        target_list = torch.cat([target_list, target])
-        u_value_list = torch.cat([u_value_list, u_value])
-        log_prob_list = torch.cat([log_prob_list, log_prob.reshape(-1)])
+        # with n-step returns nothing is stored during the first n-1 steps of the run
+        if len(replay_buffer) > 0:
+            sample_transitions = sampler.sample()
+            indices = sample_transitions.pop('indices', None)
+            # update the critic's q approximation using the sampled transitions
+            loss1, td_errors = update_critic(**sample_transitions)
+            running_loss1_mean += loss1
+            if prioritized_replay:
+                sampler.update_priorities(indices, td_errors)
+
+        episode.add(states=cur_state, actions=action, u_values=u_value, targets=target)
 
         episode_reward += reward
         episode_timestep += 1
         cur_state = next_state
 
+    target_list, u_value_list = episode['targets'].squeeze(-1), episode['u_values'].squeeze(-1)
+    # the actor hasnt changed during the episode, so these are the log probabilities of the actions taken
+    log_prob_list = actor.log_prob(episode['states'], episode['actions'])
     # Update parameters of actor by policy gradient
     actor_optimizer.zero_grad()
     # compute the gradient from the sampled log probability
@@ -152,6 +179,8 @@ for episode_i in range(train_episodes):
               'Avg Timestep : ', avg_history['timesteps'][-1])
 
 
+sampler.close()
+
 # In[]:
 import matplotlib.pyplot as plt
 
@@ -175,17 +204,24 @@ plt.show()
 # from gym import wrappers
 env = gym.make('CartPole-v0')
 # env = wrappers.Monitor(env, 'episode_shakti')
+# act with a numpy snapshot of the trained actor
+numpy_actor = NumpyMLP(actor)
+# draw the episode without the viewer and encode it to a gif in the background, the training is over so keep
+# every frame
+rasterizer = CartPoleRasterizer()
+video = FrameWriter('episode.gif', fps=50, block=True)
 cur_state = env.reset()
 total_step = 0
 total_reward = 0.0
 done = False
 while not done:
-    action, probs = actor.select_action(torch.Tensor(cur_state))
+    action = numpy_actor.select_action(cur_state)
     next_state, reward, done, info = env.step(action.item())
     total_reward += reward
-    env.render(mode='rgb_array')
+    video.write(rasterizer.render(env.unwrapped.state))
     total_step += 1
     cur_state = next_state
+video.close()
 print("Total timesteps = {}, total reward = {}".format(total_step, total_reward))
 
 env.close()
@@ -1,14 +1,16 @@
 import torch
 import torch.optim as optim
 import gym
-from dqn import ReplayBuffer
+from dqn import TorchReplayBuffer
 from torch.distributions import Categorical
 from torch.nn.functional import mse_loss
 import numpy as np
 from torch.optim.lr_scheduler import StepLR
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from actor_critic_structure import Actor, Critic
-from copy import deepcopy
+from actor_critic_structure import Actor, Critic, ActorCritic, TargetNetwork, EpisodeBuffer, evaluate_episode
+from numpy_inference import NumpyMLP
+from cartpole_rendering import CartPoleRasterizer, FrameWriter
+from return_functions import lambda_advantages
 
 
 # In[]:
@@ -54,18 +56,42 @@ critic_learning_rate = 1e-2
 train_episodes = 5000
 
 env = gym.make('CartPole-v1')
-actor = Actor(input_size=env.observation_space.shape[0], output_size=env.action_space.n, hidden_size=24)
-
-# Approximating the Value function
-critic = Critic(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24)
+# share the first hidden layers between the actor and the critic, acting and evaluating the current state is then
+# a single forward pass
+shared_trunk = False
+if shared_trunk:
+    actor_critic = ActorCritic(input_size=env.observation_space.shape[0],
+                               output_size=env.action_space.n, hidden_size=24)
+    actor, critic = actor_critic.actor, actor_critic.critic
+else:
+    actor = Actor(input_size=env.observation_space.shape[0], output_size=env.action_space.n, hidden_size=24)
+
+    # Approximating the Value function
+    critic = Critic(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24)
 # critic_old is used for fixing the target in learning the V function
-critic_old = deepcopy(critic)
+critic_old = TargetNetwork(critic)
 copy_epoch = 100
 
 optimizer_algo = 'batch'
+# evaluate V(s_t) and the targets of the whole episode in two batched forward passes at the end of the episode instead
+# of once per timestep, only with the batch actor update. The critic keeps learning from the replay buffer during the
+# episode, so both are the ones of the critic at the end of the episode
+deferred_evaluation = False
+# the sgd update needs V(s_t) and the target while acting
+assert not deferred_evaluation or optimizer_algo == 'batch', 'deferred_evaluation needs the batch actor update'
+# lambda of the GAE advantages of the batch actor update, 0 uses the TD error of every step as before and values
+# closer to 1 sum the discounted TD errors of the rest of the episode, less biased by the critic but noisier
+gae_lambda = 0.0
+# per episode storage of the transitions, grown if an episode is longer
+episode = EpisodeBuffer(max_episode_len=500)
 
 # Critic is always optimized in batch
-critic_optimizer = optim.Adam(critic.parameters(), lr=critic_learning_rate)
+if shared_trunk:
+    # the trunk is only trained by the actor's optimizer, it then has a single optimizer state and step, and the
+    # replay updates of the critic dont change the actor during the episode
+    critic_optimizer = optim.Adam(critic.head_parameters(), lr=critic_learning_rate)
+else:
+    critic_optimizer = optim.Adam(critic.parameters(), lr=critic_learning_rate)
 
 # actor is optimized either in batch or sgd
 if optimizer_algo == 'sgd':
@@ -88,17 +114,19 @@ running_loss2_mean = 0
 loss1_history = []
 loss2_history = []
 # initialize policy and replay buffer
-replay_buffer = ReplayBuffer()
+replay_buffer = TorchReplayBuffer()
 actor_replay_buffer = ActorReplayBuffer()
 
 
 # In[]:
 
 
-def update_critic(cur_states, actions, next_states, rewards, dones):
+def update_critic(cur_states, actions, next_states, rewards, dones, gammas=None):
 
+    # n-step transitions carry their own discount gamma^n, one step transitions use gamma
+    discounts = gamma if gammas is None else gammas
     # target doesnt change when its terminal, thus multiply with (1-done)
-    targets = rewards + torch.mul(1 - dones, gamma*critic(next_states).squeeze(-1) )
+    targets = rewards + torch.mul(1 - dones, discounts*critic(next_states).squeeze(-1) )
     # expanded_targets are the Q values of all the actions for the current_states sampled
     # from the previous experience. These are the predictions
     expanded_targets = critic(cur_states).squeeze(-1)
@@ -116,7 +144,7 @@ for episode_i in range(train_episodes):
 
     # make a copy every copy_epoch epochs
     if episode_i % copy_epoch == 0:
-        critic_old = deepcopy(critic)
+        critic_old.hard_update()
 
     episode_timestep = 0
     episode_reward = 0.0
@@ -124,12 +152,26 @@ for episode_i in range(train_episodes):
     done = False
     cur_state = torch.Tensor(env.reset())
 
-    log_prob_list = torch.Tensor()
-    u_value_list = torch.Tensor()
-    target_list = torch.Tensor()
+    episode.reset()
 
     while not done:
-        action, log_prob = actor.select_action(cur_state)
+        if optimizer_algo == 'batch':
+            # the actor only learns at the end of the episode, so act without a graph and recompute the log
+            # probabilities of the whole episode there in one batched forward pass
+            if shared_trunk:
+                # u_value is only stored for the end of the episode as well, so both come from one pass of the trunk
+                with torch.inference_mode():
+                    action, _, u_value = actor_critic.select_action(cur_state)
+            else:
+                with torch.inference_mode():
+                    action, _ = actor.select_action(cur_state)
+                if not deferred_evaluation:
+                    u_value = critic(cur_state)
+        elif shared_trunk:
+            action, log_prob, u_value = actor_critic.select_action(cur_state)
+        else:
+            action, log_prob = actor.select_action(cur_state)
+            u_value = critic(cur_state)
 
         # take action in the environment
         next_state, reward, done, info = env.step(action.item())
@@ -140,7 +182,6 @@ for episode_i in range(train_episodes):
         else:
             reward = 20
 
-        u_value = critic(cur_state)
         # Update parameters of critic by TD(0)
         # TODO : Use TD Lambda here and compare the performance
 
@@ -148,7 +189,12 @@ for episode_i in range(train_episodes):
         # target = reward + gamma * critic(next_state)
         # Using 1-done even in the target for actor since the next state wont have any meaning when done=1
         # TODO : Remove this line if 1-done is a wrong concept in actor
-        target = reward + gamma * (1-done) * critic(next_state)
+        if deferred_evaluation:
+            episode.add(states=cur_state, actions=action, next_states=next_state, rewards=reward, dones=done)
+        else:
+            target = reward + gamma * (1-done) * critic(next_state)
+            if optimizer_algo == 'batch':
+                episode.add(states=cur_state, actions=action, u_values=u_value, targets=target, dones=done)
 
 
         # TODO : Checking if removing replay buffer and updating Q in batches improves anything
@@ -184,16 +230,12 @@ for episode_i in range(train_episodes):
             # compute the gradient from the sampled log probability
             #  the log probability times the Q of the action that you just took in that state
             # TODO : the target here is still a moving target, see if fixing this for sometime leads to any improvement
-            loss2 = -log_prob * (target - u_value) # the advantage function used is the TD error
+            # the advantage is a constant for the actor, with a shared trunk its gradient would train the value estimate
+            loss2 = -log_prob * (target - u_value).detach() # the advantage function used is the TD error
             loss2.backward()
             running_loss2_mean += loss2.item()
             actor_optimizer.step()
 
-        elif optimizer_algo == 'batch':
-            target_list = torch.cat([target_list, target])
-            u_value_list = torch.cat([u_value_list, u_value])
-            log_prob_list = torch.cat([log_prob_list, log_prob.reshape(-1)])
-
         episode_reward += reward
         episode_timestep += 1
         cur_state = next_state
@@ -210,6 +252,13 @@ for episode_i in range(train_episodes):
 
 
     if optimizer_algo == 'batch':
+        if deferred_evaluation:
+            u_value_list, target_list = evaluate_episode(critic, critic, episode['states'], episode['next_states'],
+                                                         episode['rewards'], episode['dones'], gamma)
+        else:
+            u_value_list, target_list = episode['u_values'].squeeze(-1), episode['targets'].squeeze(-1)
+        # the actor hasnt changed during the episode, so these are the log probabilities of the actions taken
+        log_prob_list = actor.log_prob(episode['states'], episode['actions'])
         # Update parameters of actor by policy gradient
         actor_optimizer.zero_grad()
         # compute the gradient from the sampled log probability
@@ -221,9 +270,10 @@ for episode_i in range(train_episodes):
         # that only occur in some episodes, and the majority of episodes only experience common events with
         # lower-scale rewards, then this trick will mess up training. In cartpole environment this is not of concern
         # since all the rewards are 1 itself
-        multiplication_factor = target_list - u_value_list
+        # the advantages of the whole episode in one reverse scan over its TD errors
+        multiplication_factor = lambda_advantages(target_list - u_value_list, episode['dones'], gamma, gae_lambda)
         multiplication_factor = (multiplication_factor - multiplication_factor.mean() ) / multiplication_factor.std()
-        loss2 = torch.sum(torch.mul(-log_prob_list, multiplication_factor))  # the advantage function used is the TD error
+        loss2 = torch.sum(torch.mul(-log_prob_list, multiplication_factor))  # the advantage function used is GAE
 
         loss2.backward()
         running_loss2_mean += loss2.item()
@@ -273,16 +323,23 @@ plt.show()
 
 # In[]:
 
+# act with a numpy snapshot of the trained actor
+numpy_actor = NumpyMLP(actor)
+# draw the episode without the viewer and encode it to a gif in the background, the training is over so keep
+# every frame
+rasterizer = CartPoleRasterizer()
+video = FrameWriter('episode.gif', fps=50, block=True)
 cur_state = env.reset()
 total_step = 0
 total_reward = 0.0
 done = False
 while not done:
-    action, probs = actor.select_action(torch.Tensor(cur_state))
+    action = numpy_actor.select_action(cur_state)
     next_state, reward, done, info = env.step(action.item())
     total_reward += reward
-    env.render(mode='rgb_array')
+    video.write(rasterizer.render(env.unwrapped.state))
     total_step += 1
     cur_state = next_state
+video.close()
 print("Total timesteps = {}, total reward = {}".format(total_step, total_reward))
 env.close()
@@ -4,7 +4,10 @@ import gym
 import numpy as np
 from torch.optim.lr_scheduler import StepLR
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from actor_critic_structure import Actor, Critic
+from actor_critic_structure import Actor, Critic, EpisodeBuffer
+from return_functions import discounted_returns
+from numpy_inference import NumpyMLP
+from cartpole_rendering import CartPoleRasterizer, FrameWriter
 
 # In[]:
 
@@ -47,6 +50,8 @@ running_loss1_mean = 0
 running_loss2_mean = 0
 loss1_history = []
 loss2_history = []
+# per episode storage of the transitions, grown if an episode is longer
+episode = EpisodeBuffer(max_episode_len=500)
 
 
 # In[]:
@@ -62,30 +67,26 @@ for episode_i in range(train_episodes):
     if optimizer_algo == 'sgd':
         scheduler.step()
 
-    history = list()
+    episode.reset()
 
     while not done:
-        action, log_prob = actor.select_action(cur_state)
+        # act without a graph, the log probabilities are recomputed from the states and actions at the update
+        with torch.inference_mode():
+            action, _ = actor.select_action(cur_state)
         # take action in the environment
         next_state, reward, done, info = env.step(action.item())
         episode_reward += reward
         episode_timestep += 1
-        history.append([cur_state, next_state, action, log_prob, reward])
+        episode.add(states=cur_state, actions=action, rewards=reward)
         cur_state = torch.Tensor(next_state)
 
     #  Now calculate the return
     if optimizer_algo == 'adam':
         # calculate the expected return and update the parameter wrt the expected gradient of the objective function
-        return_values = torch.Tensor()
-        log_probabilities = torch.Tensor()
-        for i in range(len(history)):
-            return_t = 0
-            el = 0
-            for j in range(i, len(history)):
-                return_t += np.power(gamma, el)*history[j][-1]
-                el += 1
-            return_values = torch.cat([return_values, torch.Tensor([return_t])])
-            log_probabilities = torch.cat([log_probabilities, history[i][3].reshape(-1)])
+        # the return of every timestep in one reverse pass
+        return_values = discounted_returns(episode['rewards'], gamma)
+        # log probabilities of all the actions of the episode in one forward pass, the actor hasnt changed since
+        log_probabilities = actor.log_prob(episode['states'], episode['actions'])
         actor_optimizer.zero_grad()
         # Scale rewards to reduce variance
         return_values = (return_values - return_values.mean()) / return_values.std()
@@ -98,16 +99,15 @@ for episode_i in range(train_episodes):
     elif optimizer_algo == 'sgd':
         # calculate the return for each transition and update the parameter wrt
         # stochastic gradient of the objective function
-        for i in range(len(history)):
-            return_t = 0
-            el = 0
-            for j in range(i, len(history)):
-                return_t += np.power(gamma, el)*history[j][-1]
-                el += 1
+        return_values = discounted_returns(episode['rewards'], gamma)
+        for i in range(len(episode)):
+            return_t = return_values[i].item()
             actor_optimizer.zero_grad()
             # here reward scaling cannot be done since no batch is available to us at all
             # -1 is important!!
-            loss2 = torch.sum(torch.mul(-1*history[i][3].reshape(-1), torch.Tensor([return_t])))
+            # the actor is updated after every transition, so the log probability is the one of the current actor
+            log_prob = actor.log_prob(episode['states'][i], episode['actions'][i])
+            loss2 = torch.sum(torch.mul(-1*log_prob.reshape(-1), torch.Tensor([return_t])))
             loss2.backward()
             running_loss2_mean += loss2.item()
             actor_optimizer.step()
@@ -147,16 +147,23 @@ plt.show()
 
 # In[]:
 
+# act with a numpy snapshot of the trained actor
+numpy_actor = NumpyMLP(actor)
+# draw the episode without the viewer and encode it to a gif in the background, the training is over so keep
+# every frame
+rasterizer = CartPoleRasterizer()
+video = FrameWriter('episode.gif', fps=50, block=True)
 cur_state = env.reset()
 total_step = 0
 total_reward = 0.0
 done = False
 while not done:
-    action, probs = actor.select_action(torch.Tensor(cur_state))
+    action = numpy_actor.select_action(cur_state)
     next_state, reward, done, info = env.step(action.item())
     total_reward += reward
-    env.render(mode='rgb_array')
+    video.write(rasterizer.render(env.unwrapped.state))
     total_step += 1
     cur_state = next_state
+video.close()
 print("Total timesteps = {}, total reward = {}".format(total_step, total_reward))
 env.close()
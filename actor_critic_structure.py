@@ -8,6 +8,8 @@ from torch.nn.functional import mse_loss
 import numpy as np
 from torch.optim.lr_scheduler import StepLR
 from torch.optim.lr_scheduler import ReduceLROnPlateau
+from copy import deepcopy
+from scipy.signal import lfilter
 
 # In[]:
 
@@ -15,6 +17,213 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 #  2. Fixing target
 
 
+class TruncatedNormal:
+    """
+    Normal distribution truncated to [low, high], sampled by inverse CDF. Every sample is one uniform draw pushed
+    through the inverse CDF of the normal restricted to the bounds, so it costs the same however close the mean is
+    to a bound, and a whole batch of means is sampled in one call.
+    """
+    def __init__(self, loc, scale, low=-1.0, high=1.0):
+        self.loc = loc
+        self.scale = torch.as_tensor(scale, dtype=loc.dtype)
+        self.low = low
+        self.high = high
+        self._normal = Normal(loc, self.scale)
+        self._cdf_low = self._normal.cdf(torch.as_tensor(low, dtype=loc.dtype))
+        self._cdf_high = self._normal.cdf(torch.as_tensor(high, dtype=loc.dtype))
+        # log of the probability mass of the normal within the bounds
+        self._log_mass = torch.log(self._cdf_high - self._cdf_low)
+
+    def sample(self):
+        with torch.no_grad():
+            u = torch.rand_like(self.loc)
+            p = self._cdf_low + u * (self._cdf_high - self._cdf_low)
+            # keep p away from 0 and 1, the inverse CDF is infinite there
+            eps = torch.finfo(p.dtype).eps
+            p = p.clamp(eps, 1 - eps)
+            return self._normal.icdf(p).clamp(self.low, self.high)
+
+    def log_prob(self, value):
+        log_prob = self._normal.log_prob(value) - self._log_mass
+        out_of_range = (value < self.low) | (value > self.high)
+        return log_prob.masked_fill(out_of_range, -float('inf'))
+
+
+class EpisodeBuffer:
+    """
+    Storage of the transitions of one episode. Each column is a tensor allocated for max_episode_len steps on the
+    first add and doubled when an episode runs longer, so appending is O(1) instead of the O(T) copy of
+    torch.cat([lst, x]). The values are stored detached, whatever needs a graph at the end of the episode (log
+    probabilities, V(s_t) to train on, actor outputs) is recomputed from the stored states in one batched forward pass.
+    buffer['states'] etc. are views of the first len(buffer) rows, valid until the next add.
+    """
+    def __init__(self, max_episode_len=500):
+        self.capacity = max_episode_len
+        self._columns = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, name):
+        return self._columns[name][:self._size]
+
+    def reset(self):
+        # the storage is kept for the next episode
+        self._size = 0
+
+    def _grow(self):
+        self.capacity *= 2
+        for name, column in self._columns.items():
+            grown = column.new_empty((self.capacity,) + column.shape[1:])
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+
+    def add(self, **values):
+        """
+        :param values: the values of one timestep, one keyword per column, e.g. states=cur_state, rewards=reward
+        """
+        if self._size == self.capacity:
+            self._grow()
+        for name, value in values.items():
+            if isinstance(value, torch.Tensor):
+                value = value.detach()
+            else:
+                # python and numpy numbers (rewards, states from the environment) are stored as float32
+                value = torch.as_tensor(value, dtype=torch.bool if isinstance(value, bool) else torch.float32)
+            if name not in self._columns:
+                self._columns[name] = torch.empty((self.capacity,) + value.shape, dtype=value.dtype)
+            self._columns[name][self._size] = value
+        self._size += 1
+
+
+def evaluate_episode(critic, target_critic, states, next_states, rewards, dones, gamma):
+    """
+    V(s_t) and the TD(0) targets r_t + gamma * (1-done_t) * V_target(s_t+1) of a whole episode, in two batched forward
+    passes instead of two per timestep
+    :param critic: the critic giving V(s_t), its output keeps the graph so it can be trained on
+    :param target_critic: the critic giving V(s_t+1) of the targets, evaluated without a graph
+    :param states: (T, state_dim) tensor of the states of the episode, e.g. the 'states' of an EpisodeBuffer
+    :param next_states: (T, state_dim) tensor of the next states
+    :param rewards: (T,) tensor of the rewards
+    :param dones: (T,) tensor of the done flags
+    :return: V(s_t) and the targets, both of shape (T,)
+    """
+    u_values = critic(states).squeeze(-1)
+    with torch.no_grad():
+        targets = rewards + gamma * (1 - dones.float()) * target_critic(next_states).squeeze(-1)
+    return u_values, targets
+
+
+def acla_repeat_counts(td_errors, running_variance, beta):
+    """
+    Number of ACLA updates of each action as in Van Hasselt and Wiering, ceil(TD error / std of the TD errors) for a
+    positive TD error and 0 otherwise. The variance is the running average of the squared positive TD errors, updated
+    in the order of the timesteps like the per step update does
+    :param td_errors: (T,) tensor of the TD errors of an episode or minibatch
+    :param running_variance: the running variance before the first of them
+    :param beta: the momentum of the running variance
+    :return: (T,) long tensor of the number of updates and the running variance after the last positive TD error
+    """
+    td_errors = td_errors.detach().cpu().double().numpy().reshape(-1)
+    positive = td_errors > 0
+    counts = np.zeros(len(td_errors), dtype=np.int64)
+    if not positive.any():
+        return torch.as_tensor(counts), running_variance
+    # var_i = (1-beta) * var_i-1 + beta * td_i^2 for all the positive TD errors at once
+    variances, _ = lfilter([beta], [1, beta - 1], np.square(td_errors[positive]),
+                           zi=[(1 - beta) * float(running_variance)])
+    counts[positive] = np.ceil(td_errors[positive] / np.sqrt(variances))
+    return torch.as_tensor(counts), torch.tensor(variances[-1], dtype=torch.float32)
+
+
+def repeated_actor_update(actor, optimizer, states, actions, counts, exact=False):
+    """
+    The ACLA updates of an episode or minibatch, the output of the actor for states[i] being moved towards actions[i]
+    counts[i] times. By default a single step on the squared errors weighted by the counts, the gradient of which is
+    the sum of the gradients of all the repeated steps taken at the same weights. With exact=True max(counts) steps,
+    the j-th one on the states with more than j updates left, which is the repeated update for a single state and
+    follows it closely with plain SGD for many
+    :param actor: the actor
+    :param optimizer: the optimizer of the actor
+    :param states: (T, state_dim) tensor of states
+    :param actions: (T, action_dim) tensor of the actions taken in them
+    :param counts: (T,) number of updates of each action, e.g. from acla_repeat_counts
+    :param exact: take one step per repeat instead of a single weighted step
+    :return: the sum of the losses of the steps
+    """
+    update = counts > 0
+    states, actions, counts = states[update], actions[update].detach(), counts[update]
+    if not len(counts):
+        return 0.0
+    if exact:
+        steps = [(counts > j).float() for j in range(int(counts.max()))]
+    else:
+        steps = [counts.float()]
+    total_loss = 0.0
+    for weights in steps:
+        optimizer.zero_grad()
+        # the mse of every state, like the loss of the update of a single state
+        errors = torch.pow(actions - actor(states), 2).reshape(len(states), -1).mean(-1)
+        loss = torch.sum(weights * errors)
+        loss.backward()
+        optimizer.step()
+        total_loss += loss.item()
+    return total_loss
+
+
+class TargetNetwork:
+    """
+    Frozen copy of a network used for the TD targets, updated in place. With tau=None update() copies the weights of
+    the network every update_interval calls, otherwise every call moves them towards the network by Polyak averaging,
+    target = (1-tau)*target + tau*network. Both reuse the parameter storage of the copy through torch._foreach ops,
+    instead of deepcopying the network again.
+    """
+    def __init__(self, network, tau=None, update_interval=1):
+        self.network = network
+        self.target = deepcopy(network)
+        self.target.requires_grad_(False)
+        self.tau = tau
+        self.update_interval = update_interval
+        self.updates = 0
+        self._network_params = list(network.parameters())
+        self._target_params = list(self.target.parameters())
+
+    def __call__(self, x):
+        return self.target(x)
+
+    def evaluate(self, next_states):
+        """
+        values of a batch of next states without a graph
+        """
+        with torch.no_grad():
+            return self.target(next_states)
+
+    def update(self):
+        if self.tau is None:
+            if self.updates % self.update_interval == 0:
+                self.hard_update()
+        else:
+            self.soft_update(self.tau)
+        self.updates += 1
+
+    def hard_update(self):
+        with torch.no_grad():
+            torch._foreach_copy_(self._target_params, self._network_params)
+            for target_buffer, buffer in zip(self.target.buffers(), self.network.buffers()):
+                target_buffer.copy_(buffer)
+
+    def soft_update(self, tau):
+        with torch.no_grad():
+            torch._foreach_lerp_(self._target_params, self._network_params, tau)
+
+    def state_dict(self):
+        return self.target.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.target.load_state_dict(state_dict)
+
+
 class Critic(nn.Module):
     def __init__(self, input_size, output_size=1, hidden_size=12):
         super(Critic, self).__init__()
@@ -106,16 +315,26 @@ class Actor(nn.Module):
             out = 2*out - 1
         return out
 
-    def select_action(self, current_state):
+    def select_action(self, current_state, scale=0.1):
         """
         selects an action as per some decided exploration
-        :param current_state: the current state
+        :param current_state: the current state, or a batch of states
+        :param scale: standard deviation of the gaussian exploration for continuous action spaces
         :return: the chosen action and the log probility to act as the gradient
 
+        """
+        return self.explore(self(current_state), scale=scale)
+
+    def explore(self, out, scale=0.1):
+        """
+        exploration around the output of the network
+        :param out: output of forward for the current state(s)
+        :param scale: standard deviation of the gaussian exploration for continuous action spaces
+        :return: the chosen action and the log probility to act as the gradient
         """
         if not self.continuous:
             # if its not continuous action space then use epsilon greedy selection
-            probs = self(current_state) # probs is the probability of each of the discrete actions possible
+            probs = out # probs is the probability of each of the discrete actions possible
             # No gaussian exploration can be performed since the actions are discrete and not continuous
             # gaussian would make sense and feasibility only when actions are continuous
             m = Categorical(probs)
@@ -123,14 +342,154 @@ class Actor(nn.Module):
             return action, m.log_prob(action)
         else:
             # use gaussian or other form of exploration in continuous action space
-            action = self(current_state) # action is the action predicted for this current_state
-            # now time to explore, so sample from a gaussian distribution centered at action
-            # TODO : This scale can be controlled, its the variance around the mean action
-            m = Normal(loc=action, scale=torch.Tensor([0.1]))
+            action = out # action is the action predicted for this current_state
+            # now time to explore, so sample from a gaussian distribution centered at action and truncated to
+            # -1 to +1, this replaces resampling until the action is within range
+            m = TruncatedNormal(loc=action, scale=scale, low=-1.0, high=1.0)
             explored_action = m.sample()
-            # keep sampling new actions until it is within -1 to +1.
-            while not (explored_action <= +1 and explored_action >= -1):
-                explored_action = m.sample()
             # Note that the log prob should be at the original action, not at the exploration since the gradient used
             # will be the gradient of actor's prediction, not of actor's exploration
             return explored_action, m.log_prob(action)
+
+    def log_prob(self, states, actions, scale=0.1):
+        """
+        log probabilities as returned by select_action, e.g. when acting under torch.inference_mode and learning from
+        the whole episode afterwards, in one forward pass over all of its states
+        :param states: (N, state_dim) tensor of states
+        :param actions: the N actions taken in these states, as returned by select_action
+        :param scale: standard deviation of the gaussian exploration for continuous action spaces
+        :return: (N,) log probabilities, or (N, action_dim) for continuous action spaces
+        """
+        out = self(states)
+        if not self.continuous:
+            # actions sampled under torch.inference_mode cannot be saved for backward, a clone of them can
+            return Categorical(out).log_prob(actions.clone())
+        # like explore, the log prob is at the predicted action and not at the explored one that was taken
+        return TruncatedNormal(loc=out, scale=scale, low=-1.0, high=1.0).log_prob(out)
+
+    def select_actions(self, states, scale=0.1):
+        """
+        selects actions for a batch of states with one forward pass
+        :param states: (N, state_dim) array or tensor of states
+        :param scale: standard deviation of the gaussian exploration for continuous action spaces
+        :return: the N chosen actions and their N log probabilities
+        """
+        states = torch.as_tensor(np.asarray(states), dtype=torch.float32).reshape(-1, self.layer1[0].in_features)
+        return self.select_action(states, scale=scale)
+
+
+class ActorHead(nn.Module):
+    """
+    Policy head of an ActorCritic, usable wherever an Actor is: it runs the shared trunk followed by its own layers,
+    and has the same select_action, select_actions and explore
+    """
+    def __init__(self, trunk, output_size, hidden_size=12, continuous=False):
+        super(ActorHead, self).__init__()
+        self.continuous = continuous
+        self.trunk = trunk
+        self.layer3 = nn.Sequential(
+            nn.Linear(hidden_size, hidden_size),
+            nn.ReLU()
+        )
+        if continuous:
+            self.output_layer = nn.Sequential(
+                nn.Linear(hidden_size, output_size),
+                nn.Sigmoid()
+            )
+        else:
+            self.output_layer = nn.Sequential(
+                nn.Linear(hidden_size, output_size),
+                nn.Softmax(dim=-1)
+            )
+
+    def head(self, features):
+        out = self.layer3(features)
+        out = self.output_layer(out)
+        # transform the output between -1 to 1 for continuous action spaces
+        if self.continuous:
+            out = 2*out - 1
+        return out
+
+    def forward(self, x):
+        return self.head(self.trunk(x))
+
+    select_action = Actor.select_action
+    explore = Actor.explore
+    log_prob = Actor.log_prob
+
+    def select_actions(self, states, scale=0.1):
+        """
+        same as Actor.select_actions, the states go through the shared trunk
+        """
+        states = torch.as_tensor(np.asarray(states), dtype=torch.float32).reshape(-1, self.trunk[0].in_features)
+        return self.select_action(states, scale=scale)
+
+
+class CriticHead(nn.Module):
+    """
+    Value head of an ActorCritic, usable wherever a Critic is
+    """
+    def __init__(self, trunk, output_size=1, hidden_size=12):
+        super(CriticHead, self).__init__()
+        self.trunk = trunk
+        self.layer3 = nn.Sequential(
+            nn.Linear(hidden_size, hidden_size),
+            nn.ReLU()
+        )
+        self.output_layer = nn.Linear(hidden_size, output_size)
+
+    def head(self, features):
+        return self.output_layer(self.layer3(features))
+
+    def head_parameters(self):
+        """
+        the parameters of this head without the ones of the shared trunk
+        """
+        return [parameter for name, parameter in self.named_parameters() if not name.startswith('trunk.')]
+
+    def forward(self, x):
+        return self.head(self.trunk(x))
+
+
+class ActorCritic(nn.Module):
+    """
+    Actor and critic sharing the first two hidden layers, each with its own last hidden layer and output layer.
+    One forward call gives both the policy output and the value of a state, so acting and evaluating the current
+    state costs a single pass through the trunk. actor and critic are the two heads, each behaving like an Actor and
+    a Critic, so existing code (optimizers over actor.parameters(), deepcopy(critic) as the fixed target, NumpyMLP
+    of the actor) keeps working. An optimizer over all the parameters updates both heads and the trunk in one step.
+    With separate actor and critic optimizers, give the critic's only critic.head_parameters(), so that the trunk
+    is stepped by one optimizer.
+    """
+    def __init__(self, input_size, output_size, hidden_size=12, continuous=False, value_size=1):
+        super(ActorCritic, self).__init__()
+        self.continuous = continuous
+        self.trunk = nn.Sequential(
+            nn.Linear(input_size, hidden_size),
+            nn.ReLU(),
+            nn.Linear(hidden_size, hidden_size),
+            nn.ReLU()
+        )
+        self.actor = ActorHead(self.trunk, output_size, hidden_size=hidden_size, continuous=continuous)
+        self.critic = CriticHead(self.trunk, value_size, hidden_size=hidden_size)
+
+    def forward(self, x):
+        """
+        :return: the output of the actor (action probabilities or the action) and the value of x
+        """
+        features = self.trunk(x)
+        return self.actor.head(features), self.critic.head(features)
+
+    def value(self, states):
+        """
+        value of a batch of states, e.g. of the next states, without running the policy head
+        """
+        return self.critic(states)
+
+    def select_action(self, current_state, scale=0.1):
+        """
+        :return: the chosen action, its log probability and the value of current_state, from one forward pass
+        """
+        out, value = self(current_state)
+        action, log_prob = self.actor.explore(out, scale=scale)
+        return action, log_prob, value
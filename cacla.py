@@ -1,15 +1,17 @@
 import torch
 import torch.optim as optim
 import gym
-from dqn import ReplayBuffer
+from dqn import TorchReplayBuffer, PrioritizedReplayBuffer, PrefetchSampler
 from torch.distributions import Categorical
 from torch.nn.functional import mse_loss
 import numpy as np
 from torch.optim.lr_scheduler import StepLR
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from actor_critic_structure import Actor, Critic
-from copy import deepcopy
+from actor_critic_structure import Actor, Critic, ActorCritic, TargetNetwork, EpisodeBuffer, evaluate_episode, \
+    acla_repeat_counts, repeated_actor_update
+from numpy_inference import NumpyMLP
 from cartpoleContinuous import ContinuousCartPoleEnv
+from checkpoint import CheckpointWriter, checkpoint_exists, load_checkpoint
 
 # In[]:
 
@@ -51,20 +53,48 @@ critic_learning_rate = 1e-2
 train_episodes = 5000
 
 env = ContinuousCartPoleEnv()
-# The actor can just output an action, since the action space is continuous now
-actor = Actor(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24, continuous=True)
-
-# Approximating the Value function
-critic = Critic(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24)
+# share the first hidden layers between the actor and the critic, acting and evaluating the current state is then
+# a single forward pass
+shared_trunk = False
+if shared_trunk:
+    actor_critic = ActorCritic(input_size=env.observation_space.shape[0],
+                               output_size=1, hidden_size=24, continuous=True)
+    actor, critic = actor_critic.actor, actor_critic.critic
+else:
+    # The actor can just output an action, since the action space is continuous now
+    actor = Actor(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24, continuous=True)
+
+    # Approximating the Value function
+    critic = Critic(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24)
 
 # critic_old is used for fixing the target in learning the V function
-critic_old = deepcopy(critic)
+critic_old = TargetNetwork(critic)
 copy_epoch = 100
 
 optimizer_algo = 'batch'
+# with the sgd actor update, apply the ceil(TD error / std) repeated updates of the actions with a positive TD error
+# at the end of the episode, in a single step weighted by the number of repeats instead of one step per repeat
+batched_repeats = False
+# take max(repeats) steps instead, the j-th one on the actions with more than j repeats left, which follows the
+# repeated updates closely with plain SGD (the momentum of the sgd actor optimizer makes both differ a bit more)
+exact_repeats = False
+# evaluate V(s_t) and the targets of the whole episode in two batched forward passes at the end of the episode instead
+# of once per timestep, only with the batch actor update. The targets from critic_old are the same, but the critic
+# keeps learning from the replay buffer during the episode so V(s_t) is the one of the critic at the end of the episode
+deferred_evaluation = False
+# the per step sgd update needs V(s_t) and the target while acting
+assert not deferred_evaluation or optimizer_algo == 'batch' or batched_repeats, \
+    'deferred_evaluation needs the batch actor update or batched_repeats'
+# per episode storage of the transitions, grown if an episode is longer
+episode = EpisodeBuffer(max_episode_len=500)
 
 # Critic is always optimized in batch
-critic_optimizer = optim.Adam(critic.parameters(), lr=critic_learning_rate)
+if shared_trunk:
+    # the trunk is only trained by the actor's optimizer, it then has a single optimizer state and step, and the
+    # replay updates of the critic dont change the actor during the episode
+    critic_optimizer = optim.Adam(critic.head_parameters(), lr=critic_learning_rate)
+else:
+    critic_optimizer = optim.Adam(critic.parameters(), lr=critic_learning_rate)
 
 # actor is optimized either in batch or sgd
 if optimizer_algo == 'sgd':
@@ -87,57 +117,108 @@ running_loss2_mean = 0
 loss1_history = []
 loss2_history = []
 # initialize policy and replay buffer
-replay_buffer = ReplayBuffer()
+# replay the transitions with a high TD error more often
+prioritized_replay = False
+# bootstrap the TD targets n_step steps ahead
+n_step = 1
+if prioritized_replay:
+    replay_buffer = PrioritizedReplayBuffer(n_step=n_step, gamma=gamma)
+else:
+    replay_buffer = TorchReplayBuffer(n_step=n_step, gamma=gamma)
+# draw the next batches on a background thread while the networks are being updated
+sampler = PrefetchSampler(replay_buffer, sample_size=32, prefetch=4, pytorch=True)
+# env.step_into writes the states into a ring of float32 rows shared with the tensors the networks see, instead of a
+# new array and a new tensor every step. The replay buffer holds on to the states of the last n_step transitions
+# until it stores them, so a row is only written again after that
+state_rows = np.zeros((n_step + 2, env.observation_space.shape[0]), dtype=np.float32)
+state_views = torch.from_numpy(state_rows)
+row = 0
 actor_replay_buffer = ActorReplayBuffer()
 
 beta = 0.001  # beta is the momentum in variance updates of TD Error
 running_variance = 1
 
+# checkpoint the run every checkpoint_interval episodes
+checkpoint_dir = 'checkpoints/cacla'
+# continue the run of the last checkpoint, e.g. after it was killed, instead of starting a new one which overwrites it
+resume = False
+checkpoint_interval = 100
+checkpoint_writer = CheckpointWriter(checkpoint_dir)
+start_episode = 0
+if resume and checkpoint_exists(checkpoint_dir):
+    histories = load_checkpoint(checkpoint_dir, replay_buffer,
+                                modules={'actor': actor, 'critic': critic, 'critic_old': critic_old},
+                                optimizers={'actor': actor_optimizer, 'critic': critic_optimizer},
+                                schedulers={'actor': actor_scheduler, 'critic': critic_scheduler})
+    avg_history = histories['avg_history']
+    loss1_history = histories['loss1_history']
+    loss2_history = histories['loss2_history']
+    running_variance = histories['running_variance']
+    start_episode = len(avg_history['episodes'])
+
 
 # In[]:
 
 
-def update_critic(critic_old, cur_states, actions, next_states, rewards, dones):
+def update_critic(critic_old, cur_states, actions, next_states, rewards, dones, weights=None, gammas=None):
 
+    # n-step transitions carry their own discount gamma^n, one step transitions use gamma
+    discounts = gamma if gammas is None else gammas
     # target doesnt change when its terminal, thus multiply with (1-done)
-    targets = rewards + torch.mul(1 - dones, gamma*critic_old(next_states).squeeze(-1) )
+    targets = rewards + torch.mul(1 - dones, discounts*critic_old.evaluate(next_states).squeeze(-1) )
     # expanded_targets are the Q values of all the actions for the current_states sampled
     # from the previous experience. These are the predictions
     expanded_targets = critic(cur_states).squeeze(-1)
+    td_errors = targets.detach() - expanded_targets
     critic_optimizer.zero_grad()
-    # detach the targets from the computation graph
-    loss1 = mse_loss(input=targets.detach(), target=expanded_targets)  # the implementation is (input-target)^2
+    if weights is None:
+        # detach the targets from the computation graph
+        loss1 = mse_loss(input=targets.detach(), target=expanded_targets)  # the implementation is (input-target)^2
+    else:
+        # importance sampling weights undo the bias of sampling by priority
+        loss1 = torch.mean(weights * torch.pow(td_errors, 2))
     loss1.backward()
     critic_optimizer.step()
-    return loss1.item()
+    return loss1.item(), td_errors.detach()
 
 
 # In[]:
 
 # Train the network to predict actions for each of the states
-for episode_i in range(train_episodes):
+for episode_i in range(start_episode, train_episodes):
 
     # make a copy every copy_epoch epochs
     if episode_i % copy_epoch == 0:
-        critic_old = deepcopy(critic)
+        critic_old.hard_update()
 
     episode_timestep = 0
     episode_reward = 0.0
 
     done = False
-    cur_state = torch.Tensor(env.reset())
+    row = (row + 1) % len(state_rows)
+    state_rows[row] = env.reset()
+    cur_state = state_views[row]
 
     actors_output_list = torch.Tensor()
     action_target_list = torch.Tensor()
-    u_value_list = torch.Tensor()
-    target_list = torch.Tensor()
+    episode.reset()
 
     while not done:
-        action, _ = actor.select_action(cur_state)
+        if deferred_evaluation:
+            # the actor and critic outputs are recomputed in a batch at the end of the episode, acting needs no graph
+            with torch.no_grad():
+                action, _ = actor.select_action(cur_state)
+        elif shared_trunk:
+            action, _, u_value = actor_critic.select_action(cur_state)
+        else:
+            action, _ = actor.select_action(cur_state)
+            u_value = critic(cur_state)
 
         # take action in the environment
-        next_state, reward, done, info = env.step(action.numpy())
-        next_state = torch.Tensor(next_state)
+        # the actions are sampled between -1 and 1 already, the fast path skips the check of the action space
+        row = (row + 1) % len(state_rows)
+        reward, done = env.step_into(action, state_rows[row])
+        next_state = state_views[row]
 
         # TODO : The reward structure can be changed
         if done:
@@ -147,24 +228,30 @@ for episode_i in range(train_episodes):
         elif episode_timestep > 200:
             reward = reward * 20
 
-        u_value = critic(cur_state)
-        u_value_list = torch.cat([u_value_list, u_value])
-
-        # Update parameters of critic by TD(0)
-        # TODO : Use TD Lambda here and compare the performance
+        if deferred_evaluation:
+            episode.add(states=cur_state, actions=action, next_states=next_state, rewards=reward, dones=done)
+        else:
+            # Update parameters of critic by TD(0)
+            # TODO : Use TD Lambda here and compare the performance
 
-        # target = reward + gamma * critic(next_state)
-        # Using 1-done even in the target for actor since the next state wont have any meaning when done=1
-        # TODO : Remove this line if 1-done is a wrong concept in actor
-        target = reward + gamma * (1-done) * critic_old(next_state)
-        target_list = torch.cat([target_list, target])
+            # target = reward + gamma * critic(next_state)
+            # Using 1-done even in the target for actor since the next state wont have any meaning when done=1
+            # TODO : Remove this line if 1-done is a wrong concept in actor
+            target = reward + gamma * (1-done) * critic_old.evaluate(next_state)
+            episode.add(states=cur_state, actions=action, u_values=u_value, targets=target)
 
-        replay_buffer.add(cur_state, action, next_state, reward, done)
+        sampler.add(cur_state, action, next_state, reward, done)
         # sample minibatch of transitions from the replay buffer
         # the sampling is done every timestep and not every episode
-        sample_transitions = replay_buffer.sample_pytorch(sample_size=32)
-        # update the critic's q approximation using the sampled transitions
-        running_loss1_mean += update_critic(critic_old, **sample_transitions)
+        # with n-step returns nothing is stored during the first n-1 steps of the run
+        if len(replay_buffer) > 0:
+            sample_transitions = sampler.sample()
+            indices = sample_transitions.pop('indices', None)
+            # update the critic's q approximation using the sampled transitions
+            loss1, td_errors = update_critic(critic_old, **sample_transitions)
+            running_loss1_mean += loss1
+            if prioritized_replay:
+                sampler.update_priorities(indices, td_errors)
 
         # this section was for actor experience replay, which to my dismay performed much worse than without replay
         # actor_replay_buffer.add(target, u_value, -log_prob)
@@ -185,34 +272,45 @@ for episode_i in range(train_episodes):
         # running_loss2_mean += loss2.item()
         # actor_optimizer.step()
 
-        if target - u_value > 0:
-            # then only update the actor, see
-            if optimizer_algo == 'sgd':
-                # Update parameters of actor by ACLA
-                # TODO : the target here is still a moving target, see if fixing this for sometime leads to any improvement
-                # TODO : The updates should be of size proportional to the variance reduction
-                td_error = target - u_value
-                # TODO : Instead of runing a loop here, multiply this with the loss2 there while updating
-                running_variance = running_variance*(1-beta) + beta*torch.pow(td_error, 2)
-                # no. of updates to this action should be equal to floor(TD Error / std_dev of TD error) as per the
-                # original paper in Hasselt and Wiering
-                for el in range(int(torch.ceil(td_error / torch.sqrt(running_variance)))):
-                    actor_optimizer.zero_grad()
-                    loss2 = mse_loss(input=action.detach(), target=actor(cur_state)) # the implementation for mse
-                    # is (input - target)^2
-                    loss2.backward()
-                    actor_optimizer.step()
-                    running_loss2_mean += loss2.item()
-
-            elif optimizer_algo == 'batch':
-                action_target_list = torch.cat([action_target_list, action])
-                actors_output_list = torch.cat([actors_output_list, actor(cur_state)])
-                # log_prob_list = torch.cat([log_prob_list, log_prob.reshape(-1)])
+        # with the batch update the actions with a positive TD error are picked from the episode at its end
+        if optimizer_algo == 'sgd' and not batched_repeats and target - u_value > 0:
+            # Update parameters of actor by ACLA
+            # TODO : the target here is still a moving target, see if fixing this for sometime leads to any improvement
+            # TODO : The updates should be of size proportional to the variance reduction
+            td_error = target - u_value
+            # TODO : Instead of runing a loop here, multiply this with the loss2 there while updating
+            running_variance = running_variance*(1-beta) + beta*torch.pow(td_error, 2)
+            # no. of updates to this action should be equal to floor(TD Error / std_dev of TD error) as per the
+            # original paper in Hasselt and Wiering
+            for el in range(int(torch.ceil(td_error / torch.sqrt(running_variance)))):
+                actor_optimizer.zero_grad()
+                loss2 = mse_loss(input=action.detach(), target=actor(cur_state)) # the implementation for mse
+                # is (input - target)^2
+                loss2.backward()
+                actor_optimizer.step()
+                running_loss2_mean += loss2.item()
 
         episode_reward += reward
         episode_timestep += 1
         cur_state = next_state
 
+    if deferred_evaluation:
+        u_value_list, target_list = evaluate_episode(critic, critic_old, episode['states'], episode['next_states'],
+                                                     episode['rewards'], episode['dones'], gamma)
+    else:
+        u_value_list, target_list = episode['u_values'].squeeze(-1), episode['targets'].squeeze(-1)
+    if optimizer_algo == 'sgd' and batched_repeats:
+        # all the repeated updates of the episode, the actions and TD errors are the ones of the per step update
+        repeat_counts, running_variance = acla_repeat_counts(target_list - u_value_list, running_variance, beta)
+        running_loss2_mean += repeated_actor_update(actor, actor_optimizer, episode['states'], episode['actions'],
+                                                    repeat_counts, exact=exact_repeats)
+    if optimizer_algo == 'batch':
+        # the actions with a positive TD error are the targets of the actor, the actor hasnt changed during the
+        # episode so its outputs for them are recomputed in one batch
+        positive = (target_list - u_value_list).detach() > 0
+        action_target_list = episode['actions'][positive].squeeze(-1)
+        actors_output_list = actor(episode['states'][positive]).squeeze(-1)
+
     # # # TODO : Remove this if it doesnt improve the convergence
     # critic_optimizer.zero_grad()
     # # # TODO : Check if removing scaling improves anything
@@ -272,6 +370,19 @@ for episode_i in range(train_episodes):
               'Actor Objective : ', loss2_history[-1], 'Critic Loss', loss1_history[-1],
               'Avg Timestep : ', avg_history['timesteps'][-1])
 
+    if (episode_i + 1) % checkpoint_interval == 0:
+        # the snapshot is taken under the sampler's lock, the writing happens in the background
+        with sampler.lock:
+            checkpoint_writer.save(replay_buffer,
+                                   modules={'actor': actor, 'critic': critic, 'critic_old': critic_old},
+                                   optimizers={'actor': actor_optimizer, 'critic': critic_optimizer},
+                                   schedulers={'actor': actor_scheduler, 'critic': critic_scheduler},
+                                   histories={'avg_history': avg_history, 'loss1_history': loss1_history,
+                                              'loss2_history': loss2_history, 'running_variance': running_variance})
+
+
+sampler.close()
+checkpoint_writer.close()
 
 # In[]:
 import matplotlib.pyplot as plt
@@ -297,13 +408,15 @@ env = ContinuousCartPoleEnv()
 # from gym import wrappers
 # env = wrappers.Monitor(env, 'episode_shakti')
 import time
+# act with a numpy snapshot of the trained actor
+numpy_actor = NumpyMLP(actor)
 cur_state = env.reset()
 total_step = 0
 total_reward = 0.0
 done = False
 for el in range(1000):
-    action, probs = actor.select_action(torch.Tensor(cur_state))
-    next_state, reward, done, info = env.step(action.numpy())
+    action = numpy_actor.select_action(cur_state)
+    next_state, reward, done, info = env.step(action)
     total_reward += reward
     env.render(mode='human')
     total_step += 1
@@ -10,6 +10,21 @@ import gym
 from gym import spaces, logger
 from gym.utils import seeding
 import numpy as np
+from cartpole_rendering import CartPoleRasterizer
+
+
+def _get_rng_state(rng):
+    # gym seeds a numpy Generator or a RandomState depending on its version
+    if hasattr(rng, 'bit_generator'):
+        return rng.bit_generator.state
+    return rng.get_state()
+
+
+def _set_rng_state(rng, state):
+    if hasattr(rng, 'bit_generator'):
+        rng.bit_generator.state = state
+    else:
+        rng.set_state(state)
 
 
 class ContinuousCartPoleEnv(gym.Env):
@@ -51,6 +66,7 @@ class ContinuousCartPoleEnv(gym.Env):
 
         self.seed()
         self.viewer = None
+        self.rasterizer = None
         self.state = None
 
         self.steps_beyond_done = None
@@ -73,6 +89,36 @@ class ContinuousCartPoleEnv(gym.Env):
         theta_dot = theta_dot + self.tau * thetaacc
         return (x, x_dot, theta, theta_dot)
 
+    def stepPhysicsBatch(self, states, force):
+        """
+        The Euler step of stepPhysics for many carts at once, in place
+        :param states: (N, 4) states
+        :param force: (N,) forces applied to the carts
+        :return: states
+        """
+        x, x_dot, theta, theta_dot = states.T
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        temp = (force + self.polemass_length * theta_dot * theta_dot * sintheta) / self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / \
+            (self.length * (4.0/3.0 - self.masspole * costheta * costheta / self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / self.total_mass
+        # x and theta are moved with the old velocities, like stepPhysics
+        x += self.tau * x_dot
+        theta += self.tau * theta_dot
+        x_dot += self.tau * xacc
+        theta_dot += self.tau * thetaacc
+        return states
+
+    def outOfBounds(self, states):
+        """
+        :param states: (..., 4) states
+        :return: the done flags of the states
+        """
+        x, theta = states[..., 0], states[..., 2]
+        return (x < -self.x_threshold) | (x > self.x_threshold) | \
+            (theta < -self.theta_threshold_radians) | (theta > self.theta_threshold_radians)
+
     def step(self, action):
         assert self.action_space.contains(action), \
             "%r (%s) invalid" % (action, type(action))
@@ -104,12 +150,92 @@ Any further steps are undefined behavior.
 
         return np.array(self.state), reward, done, {}
 
+    def step_into(self, action, out):
+        """
+        Fast path of step for training loops, the action is not validated and the next state is written into out
+        instead of a new array, e.g. a float32 array shared with a tensor by torch.from_numpy
+        :param action: action between -1 and 1, a number or a one element array or tensor
+        :param out: array of 4 elements the next state is written to
+        :return: the reward and the done flag
+        """
+        force = self.force_mag * (action.item() if hasattr(action, 'item') else action)
+        self.state = x, x_dot, theta, theta_dot = self.stepPhysics(force)
+        out[:] = self.state
+        done = x < -self.x_threshold \
+            or x > self.x_threshold \
+            or theta < -self.theta_threshold_radians \
+            or theta > self.theta_threshold_radians
+
+        if not done:
+            return 1.0, False
+        if self.steps_beyond_done is None:
+            # Pole just fell!
+            self.steps_beyond_done = 0
+            return 1.0, True
+        self.steps_beyond_done += 1
+        return 0.0, True
+
     def reset(self):
         self.state = self.np_random.uniform(low=-0.05, high=0.05, size=(4,))
         self.steps_beyond_done = None
         return np.array(self.state)
 
+    def get_state(self):
+        """
+        :return: a snapshot of the env, the state of the cart, how long it is beyond done and the random generator
+        """
+        return {'state': None if self.state is None else np.array(self.state),
+                'steps_beyond_done': self.steps_beyond_done,
+                'np_random': _get_rng_state(self.np_random)}
+
+    def set_state(self, snapshot):
+        """
+        Restores a snapshot of get_state, the env then steps and resets exactly as it did after the snapshot was taken
+        """
+        self.state = None if snapshot['state'] is None else np.array(snapshot['state'])
+        self.steps_beyond_done = snapshot['steps_beyond_done']
+        _set_rng_state(self.np_random, snapshot['np_random'])
+
+    def simulate(self, action_sequences, snapshot=None):
+        """
+        Plays K action sequences from the same state in one batch, for planning or evaluating from a common start
+        state. The env itself is left as it is
+        :param action_sequences: (K, H) or (K, H, 1) actions between -1 and 1, they are not validated
+        :param snapshot: snapshot of get_state to start from, the current state by default
+        :return: the (K, H, 4) states after every action, the (K, H) rewards and the (K, H) done flags, with the
+        rewards and done flags step would return
+        """
+        if snapshot is None:
+            snapshot = self.get_state()
+        actions = np.asarray(action_sequences, dtype=np.float64)
+        actions = actions.reshape(actions.shape[0], -1)
+        num_sequences, horizon = actions.shape
+        states = np.empty((num_sequences, horizon, 4))
+        # a single start state is shared by all the sequences, (K, 4) start states are one per sequence
+        current = np.array(np.broadcast_to(snapshot['state'], (num_sequences, 4)), dtype=np.float64)
+        # like step, done is whether the cart is out of bounds and the reward is 0 once it was done before. The snapshot
+        # of the batched env holds the mask of its fallen carts instead of steps_beyond_done
+        fallen = snapshot['steps_beyond_done']
+        if not isinstance(fallen, np.ndarray):
+            fallen = fallen is not None
+        fallen = np.array(np.broadcast_to(fallen, (num_sequences,)))
+        rewards = np.empty((num_sequences, horizon))
+        dones = np.empty((num_sequences, horizon), dtype=bool)
+        for t in range(horizon):
+            self.stepPhysicsBatch(current, self.force_mag * actions[:, t])
+            states[:, t] = current
+            dones[:, t] = self.outOfBounds(current)
+            rewards[:, t] = ~(dones[:, t] & fallen)
+            fallen |= dones[:, t]
+        return states, rewards, dones
+
     def render(self, mode='human'):
+        if mode == 'rgb_array':
+            # drawn with NumPy, without the viewer and a display
+            if self.state is None:
+                return None
+            return self._get_rasterizer().render(np.asarray(self.state)).copy()
+
         screen_width = 600
         screen_height = 400
 
@@ -156,6 +282,102 @@ Any further steps are undefined behavior.
 
         return self.viewer.render(return_rgb_array=(mode == 'rgb_array'))
 
+    def _get_rasterizer(self):
+        if self.rasterizer is None:
+            self.rasterizer = CartPoleRasterizer(x_threshold=self.x_threshold, pole_length=2 * self.length)
+        return self.rasterizer
+
     def close(self):
         if self.viewer:
-            self.viewer.close()
\ No newline at end of file
+            self.viewer.close()
+
+
+class BatchedContinuousCartPoleEnv(ContinuousCartPoleEnv):
+    """
+    num_envs continuous carts simulated together. The states are a (num_envs, 4) array advanced by one vectorized
+    Euler step for all the carts, instead of one python step per cart. With auto_reset finished carts are reset right
+    away from their own random stream, so every call of step returns the next states of num_envs running episodes.
+    Without it the finished carts keep being stepped with a reward of 0, like the single env after done.
+    """
+    def __init__(self, num_envs, seed=None, auto_reset=True):
+        self.num_envs = num_envs
+        self.auto_reset = auto_reset
+        super(BatchedContinuousCartPoleEnv, self).__init__()
+        self.seed(seed)
+        # the carts which were done before, the steps_beyond_done of the single env
+        self.fallen = np.zeros(num_envs, dtype=bool)
+
+    def seed(self, seed=None):
+        # one stream per cart, the resets of a cart dont depend on when the others finish. Their seeds are drawn
+        # from a RandomState seeded with seed (numpy 1.16 has no SeedSequence to spawn them)
+        cart_seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=self.num_envs)
+        self.np_randoms = [np.random.RandomState(cart_seed) for cart_seed in cart_seeds]
+        # the stream of the first cart for code expecting the np_random of a single env
+        self.np_random = self.np_randoms[0]
+        return cart_seeds.tolist()
+
+    def stepPhysics(self, force):
+        """
+        :param force: (num_envs,) forces applied to the carts
+        """
+        return self.stepPhysicsBatch(self.state, force)
+
+    def step(self, actions):
+        """
+        :param actions: (num_envs,) or (num_envs, 1) actions between -1 and 1
+        :return: the (num_envs, 4) states, the rewards, the done flags and an info dict. With auto_reset the states of
+        the finished carts are the first states of their next episode and the last states of their episode are in
+        info['terminal_observations'] at the same rows
+        """
+        actions = np.asarray(actions, dtype=np.float64).reshape(self.num_envs)
+        assert np.all((actions >= self.min_action) & (actions <= self.max_action)), \
+            "%r (%s) invalid" % (actions, type(actions))
+        self.stepPhysics(self.force_mag * actions)
+        dones = self.outOfBounds(self.state)
+        # like the single env, 1 for the carts still running or just fallen and 0 for the ones stepped after they were
+        # done, which only happens without auto_reset
+        rewards = (~(dones & self.fallen)).astype(np.float64)
+        self.fallen |= dones
+        info = {}
+        if self.auto_reset and dones.any():
+            info['terminal_observations'] = self.state.copy()
+            self._reset_envs(np.flatnonzero(dones))
+        return self.state.copy(), rewards, dones, info
+
+    def _reset_envs(self, indices):
+        for i in indices:
+            self.state[i] = self.np_randoms[i].uniform(low=-0.05, high=0.05, size=(4,))
+        self.fallen[indices] = False
+
+    def get_state(self):
+        """
+        :return: a snapshot of the (num_envs, 4) states and of the random generators of all the carts
+        """
+        return {'state': None if self.state is None else self.state.copy(),
+                'steps_beyond_done': self.fallen.copy(),
+                'np_random': [_get_rng_state(rng) for rng in self.np_randoms]}
+
+    def set_state(self, snapshot):
+        self.state = None if snapshot['state'] is None else snapshot['state'].copy()
+        self.fallen = snapshot['steps_beyond_done'].copy()
+        for rng, state in zip(self.np_randoms, snapshot['np_random']):
+            _set_rng_state(rng, state)
+
+    def reset(self):
+        self.state = np.empty((self.num_envs, 4))
+        self._reset_envs(np.arange(self.num_envs))
+        return self.state.copy()
+
+    def render(self, mode='human'):
+        if mode == 'rgb_array':
+            # the frames of all the carts, drawn in one batch
+            if self.state is None:
+                return None
+            return self._get_rasterizer().render(self.state).copy()
+        # the viewer draws the first cart
+        states = self.state
+        self.state = None if states is None else states[0]
+        try:
+            return super(BatchedContinuousCartPoleEnv, self).render(mode)
+        finally:
+            self.state = states
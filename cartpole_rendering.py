@@ -0,0 +1,182 @@
+"""
+Headless rendering of CartPole. gym's classic_control viewer needs pyglet, OpenGL and a display, and costs milliseconds
+per frame, so the rgb_array frames are drawn here with NumPy instead, straight into preallocated uint8 arrays and for
+a whole batch of states at once. FrameWriter encodes the frames to a GIF or MP4 on a background thread, recording
+an evaluation episode then neither slows down nor crashes the training run.
+
+    rasterizer = CartPoleRasterizer()
+    video = FrameWriter('episode.gif', fps=50)
+    ...
+        video.write(rasterizer.render(env.unwrapped.state))
+    ...
+    video.close()
+"""
+
+import queue
+import threading
+import numpy as np
+
+
+class CartPoleRasterizer:
+    """
+    Draws the track, cart, pole and axle of CartPole states with the geometry and colors of gym's viewer, which are
+    the same for gym's CartPole and ContinuousCartPoleEnv: the screen spans the track of 2 * x_threshold and the pole
+    is 1 world unit long.
+    """
+    def __init__(self, screen_width=600, screen_height=400, x_threshold=2.4, pole_length=1.0):
+        self.screen_width = screen_width
+        self.screen_height = screen_height
+        self.scale = screen_width / (x_threshold * 2)
+        self.carty = 100  # TOP OF CART
+        self.polewidth = 10.0
+        self.polelen = self.scale * pole_length
+        self.cartwidth = 50.0
+        self.cartheight = 30.0
+        self.axley = self.carty + self.cartheight / 4.0
+        self.pole_color = np.array([.8, .6, .4]) * 255
+        self.axle_color = np.array([.5, .5, .8]) * 255
+        # x of the pixel centers, the screen coordinates have y going up like the viewer's
+        self._pixel_x = np.arange(screen_width) + 0.5
+        pixel_y = np.arange(screen_height) + 0.5
+        # rows of the cart in the frame (rows going down), the cart only moves horizontally
+        cart_rows = np.flatnonzero(np.abs(pixel_y - self.carty) <= self.cartheight / 2)
+        self._cart_rows = slice(screen_height - 1 - cart_rows[-1], screen_height - cart_rows[0])
+        # frames reused between calls, grown to the largest batch
+        self._frames = np.empty((0, screen_height, screen_width, 3), dtype=np.uint8)
+
+    def _to_row(self, y):
+        return self.screen_height - 1 - y
+
+    def render(self, states, out=None):
+        """
+        :param states: a single state or (N, 4) states, x and theta are the first and third elements
+        :param out: optional (N, screen_height, screen_width, 3) uint8 array the frames are drawn into
+        :return: the frame or (N, screen_height, screen_width, 3) frames. Without out they are views of the arrays of
+        the rasterizer, valid until the next call
+        """
+        states = np.asarray(states, dtype=np.float64)
+        single = states.ndim == 1
+        states = np.atleast_2d(states)
+        n = len(states)
+        if out is None:
+            if len(self._frames) < n:
+                self._frames = np.empty((n, self.screen_height, self.screen_width, 3), dtype=np.uint8)
+            out = self._frames[:n]
+        out[...] = 255
+
+        cartx = states[:, 0] * self.scale + self.screen_width / 2.0  # MIDDLE OF CART
+        # cart, the columns of which have their center within the cart
+        left = np.searchsorted(self._pixel_x, cartx - self.cartwidth / 2)
+        right = np.searchsorted(self._pixel_x, cartx + self.cartwidth / 2, side='right')
+        for frame in range(n):
+            out[frame, self._cart_rows, left[frame]:right[frame]] = 0
+
+        # pole and axle, in a window around the axle large enough for the pole of every state of the batch
+        theta = states[:, 2]
+        sin, cos = np.sin(theta), np.cos(theta)
+        reach = self.polelen - self.polewidth / 2
+        reach_x = int(np.ceil(np.abs(reach * sin).max() + self.polewidth))
+        low_y = int(np.floor(min(0.0, (reach * cos).min()) - self.polewidth))
+        high_y = int(np.ceil(max(0.0, (reach * cos).max()) + self.polewidth))
+        window_y = np.arange(int(self.axley) + low_y, int(self.axley) + high_y + 1)
+        window_y = window_y[(window_y >= 0) & (window_y < self.screen_height)]
+        # the columns of the window follow the cart of every frame
+        window_x = np.floor(cartx).astype(np.int64)[:, None] + np.arange(-reach_x, reach_x + 1)
+        dx = (window_x + 0.5 - cartx[:, None])[:, None, :]
+        dy = (window_y + 0.5 - self.axley)[None, :, None]
+        # the pole is rotated by -theta around the axle, rotate the pixels back by theta into the frame of the pole
+        local_x = cos[:, None, None] * dx - sin[:, None, None] * dy
+        local_y = sin[:, None, None] * dx + cos[:, None, None] * dy
+        inside = ((window_x >= 0) & (window_x < self.screen_width))[:, None, :]
+        pole = inside & (np.abs(local_x) <= self.polewidth / 2) & \
+            (local_y >= -self.polewidth / 2) & (local_y <= self.polelen - self.polewidth / 2)
+        frame, y, x = np.nonzero(pole)
+        out[frame, self._to_row(window_y[y]), window_x[frame, x]] = self.pole_color
+        axle = inside & (dx * dx + dy * dy <= (self.polewidth / 2) ** 2)
+        frame, y, x = np.nonzero(axle)
+        out[frame, self._to_row(window_y[y]), window_x[frame, x]] = self.axle_color
+
+        # the track is drawn last, over everything else
+        out[:, self._to_row(self.carty)] = 0
+        return out[0] if single else out
+
+
+class FrameWriter:
+    """
+    Writes frames to path with imageio on a background thread, the format follows the extension of path (.gif, or
+    .mp4 with imageio's ffmpeg plugin). write() only copies the frames into a queue of max_queue writes. If the encoder
+    falls behind, frames are dropped and counted in dropped instead of blocking the caller, unless block is True, e.g.
+    for an evaluation after the training where every frame should be kept. An error of the encoder, e.g. imageio not
+    being installed, is kept in error and stops the recording instead of raising in the caller.
+    """
+    def __init__(self, path, fps=50, max_queue=64, block=False, **writer_kwargs):
+        self.path = path
+        self.fps = fps
+        self.block = block
+        self.writer_kwargs = writer_kwargs
+        self.dropped = 0
+        self.error = None
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, frames):
+        """
+        :param frames: a (height, width, 3) frame or (N, height, width, 3) frames
+        :return: False if the frames were dropped
+        """
+        if self._closed or self.error is not None:
+            return False
+        frames = np.array(frames, dtype=np.uint8, copy=True)
+        try:
+            self._queue.put(frames, block=self.block)
+        except queue.Full:
+            self.dropped += 1 if frames.ndim == 3 else len(frames)
+            return False
+        return True
+
+    def _run(self):
+        writer = None
+        try:
+            import imageio
+            writer = imageio.get_writer(self.path, fps=self.fps, **self.writer_kwargs)
+        except Exception as error:
+            self._fail(error)
+        while True:
+            frames = self._queue.get()
+            if frames is None:
+                break
+            # keep emptying the queue after an error, so that close() never waits on a full queue
+            if writer is None:
+                continue
+            try:
+                for frame in (frames[None] if frames.ndim == 3 else frames):
+                    writer.append_data(frame)
+            except Exception as error:
+                self._fail(error)
+                writer = self._close_writer(writer)
+        self._close_writer(writer)
+
+    def _close_writer(self, writer):
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as error:
+                self._fail(error)
+        return None
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+            print('Recording to {} stopped : {}'.format(self.path, error))
+
+    def close(self):
+        """
+        Waits for the frames in the queue to be written and closes the file
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
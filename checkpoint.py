@@ -0,0 +1,182 @@
+"""
+Checkpoints of a training run, so that a killed run resumes where it stopped instead of re-warming from scratch.
+
+A checkpoint is a directory holding
+    buffer/<column>.npy : the raw replay buffer columns (and priority trees), one .npy file per column
+    trainer.pkl         : state_dicts of the networks, optimizers and lr schedulers, the RNG states, the histories
+                          and the buffer cursor
+The .npy files are memory mapped on restore, so resuming costs a few page faults rather than reading the buffer.
+"""
+
+import os
+import pickle
+import queue
+import random
+import shutil
+import threading
+from copy import deepcopy
+import numpy as np
+import torch
+from dqn import PrioritizedReplayBuffer, TorchReplayBuffer
+
+
+def _snapshot_buffer(replay_buffer):
+    # copy the columns now, the writer thread must not see the transitions added after this call
+    columns = {}
+    for name, value in replay_buffer._columns().items():
+        if value is None:
+            continue
+        if isinstance(value, torch.Tensor):
+            value = value.numpy()
+        columns[name] = np.array(value, copy=True)
+    if isinstance(replay_buffer, PrioritizedReplayBuffer):
+        columns['sum_tree'] = replay_buffer.sum_tree.tree.copy()
+        columns['min_tree'] = replay_buffer.min_tree.tree.copy()
+    meta = {'max_size': replay_buffer.max_size, 'next_idx': replay_buffer._next_idx, 'size': replay_buffer._size}
+    if isinstance(replay_buffer, PrioritizedReplayBuffer):
+        meta['max_priority'] = replay_buffer.max_priority
+    return columns, meta
+
+
+def _state_dict(obj):
+    # keras models and optimizers have no state_dict, their weights are a list of arrays
+    if hasattr(obj, 'state_dict'):
+        return deepcopy(obj.state_dict())
+    return [np.array(weights, copy=True) for weights in obj.get_weights()]
+
+
+def _load_state_dict(obj, state):
+    if hasattr(obj, 'load_state_dict'):
+        obj.load_state_dict(state)
+    else:
+        obj.set_weights(state)
+
+
+def _write(directory, columns, trainer_state):
+    # write next to the old checkpoint and swap at the end, a crash midway leaves the old one intact
+    tmp_directory = directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(os.path.join(tmp_directory, 'buffer'))
+    for name, value in columns.items():
+        np.save(os.path.join(tmp_directory, 'buffer', name + '.npy'), value)
+    with open(os.path.join(tmp_directory, 'trainer.pkl'), 'wb') as f:
+        pickle.dump(trainer_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(directory):
+        shutil.rmtree(directory + '.old', ignore_errors=True)
+        os.rename(directory, directory + '.old')
+    os.rename(tmp_directory, directory)
+    shutil.rmtree(directory + '.old', ignore_errors=True)
+
+
+def _latest(directory):
+    # a crash between the two renames of _write leaves the previous checkpoint in directory.old only
+    for candidate in (directory, directory + '.old'):
+        if os.path.exists(os.path.join(candidate, 'trainer.pkl')):
+            return candidate
+    return None
+
+
+def checkpoint_exists(directory):
+    """
+    :return: True if there is a checkpoint for load_checkpoint to restore from directory
+    """
+    return _latest(directory) is not None
+
+
+class CheckpointWriter:
+    """
+    Takes checkpoints of a training run in the background. save() only copies the state, which is cheap, and a
+    thread writes it to the disk while the training goes on. At most one checkpoint waits to be written, a newer
+    one replaces it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, replay_buffer=None, modules=None, optimizers=None, schedulers=None, histories=None):
+        """
+        :param replay_buffer: the replay buffer, its pending n-step transitions are not saved
+        :param modules: dict of name to torch module (or keras model)
+        :param optimizers: dict of name to optimizer (or keras optimizer)
+        :param schedulers: dict of name to lr scheduler
+        :param histories: dict of name to any picklable training state, e.g. avg_history, loss histories, epsilon
+        """
+        columns, buffer_meta = {}, None
+        if replay_buffer is not None and len(replay_buffer) > 0:
+            columns, buffer_meta = _snapshot_buffer(replay_buffer)
+        trainer_state = {
+            'modules': {name: _state_dict(module) for name, module in (modules or {}).items()},
+            'optimizers': {name: _state_dict(optimizer) for name, optimizer in (optimizers or {}).items()},
+            'schedulers': {name: deepcopy(scheduler.state_dict()) for name, scheduler in (schedulers or {}).items()},
+            'histories': deepcopy(histories or {}),
+            'rng': {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()},
+            'buffer': buffer_meta,
+        }
+        # drop the checkpoint still waiting to be written, this one is newer
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._queue.put((columns, trainer_state))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is not None:
+                _write(self.directory, *item)
+            self._queue.task_done()
+            if item is None:
+                return
+
+    def close(self):
+        """
+        Waits for the pending checkpoint to be written
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+def load_checkpoint(directory, replay_buffer=None, modules=None, optimizers=None, schedulers=None):
+    """
+    Restores a checkpoint written by CheckpointWriter into the given objects. The buffer columns are memory mapped
+    copy-on-write, so new transitions go to memory and the checkpoint on the disk is never modified. If a crash
+    interrupted the swap of two checkpoints, the previous one is restored from directory.old.
+    :return: the histories dict that was saved
+    """
+    latest = _latest(directory)
+    if latest is None:
+        raise FileNotFoundError('no checkpoint in {}'.format(directory))
+    directory = latest
+    with open(os.path.join(directory, 'trainer.pkl'), 'rb') as f:
+        trainer_state = pickle.load(f)
+    for name, module in (modules or {}).items():
+        _load_state_dict(module, trainer_state['modules'][name])
+    for name, optimizer in (optimizers or {}).items():
+        _load_state_dict(optimizer, trainer_state['optimizers'][name])
+    for name, scheduler in (schedulers or {}).items():
+        scheduler.load_state_dict(trainer_state['schedulers'][name])
+
+    rng = trainer_state['rng']
+    random.setstate(rng['python'])
+    np.random.set_state(rng['numpy'])
+    torch.set_rng_state(rng['torch'])
+
+    buffer_meta = trainer_state['buffer']
+    if replay_buffer is not None and buffer_meta is not None:
+        columns = {}
+        for file_name in os.listdir(os.path.join(directory, 'buffer')):
+            columns[file_name[:-len('.npy')]] = np.load(os.path.join(directory, 'buffer', file_name), mmap_mode='c')
+        if isinstance(replay_buffer, PrioritizedReplayBuffer):
+            replay_buffer.sum_tree.tree = np.array(columns.pop('sum_tree'))
+            replay_buffer.min_tree.tree = np.array(columns.pop('min_tree'))
+            replay_buffer.max_priority = buffer_meta['max_priority']
+        for name, value in columns.items():
+            if isinstance(replay_buffer, TorchReplayBuffer):
+                value = torch.from_numpy(value)
+            setattr(replay_buffer, name, value)
+        replay_buffer.max_size = buffer_meta['max_size']
+        replay_buffer._next_idx = buffer_meta['next_idx']
+        replay_buffer._size = buffer_meta['size']
+    return trainer_state['histories']
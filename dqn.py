@@ -3,6 +3,15 @@ from keras.layers import Dense
 from keras.optimizers import Adam
 import numpy as np
 import torch
+import torch.nn as nn
+from torch.nn.functional import mse_loss
+import json
+from copy import deepcopy
+import os
+from collections import deque
+import queue
+import threading
+from numpy_inference import NumpyMLP
 
 
 # Define the policy and replay buffer
@@ -29,12 +38,28 @@ class DQNPolicy:
         # the last layer is linear in the 2nd last layer's output and it gives a probability of each of the actions
         self.q_model.add(Dense(self.action_dim, activation='linear'))
         self.q_model.compile(loss='mse', optimizer=Adam(lr=self.lr))
+        # build the optimizer's weights (its iteration count and the Adam moments) now instead of on the first fit, so
+        # that a checkpoint can restore them before any update
+        self.q_model._make_train_function()
+        # numpy snapshot of the Q network, predicting through keras costs far more than the network itself
+        self.acting_model = NumpyMLP(self.q_model)
+
+    def get_weights(self):
+        return self.q_model.get_weights()
+
+    def set_weights(self, weights):
+        """
+        sets the weights of the Q network, e.g. restored from a checkpoint, and refreshes the numpy snapshot acting
+        with it
+        """
+        self.q_model.set_weights(weights)
+        self.acting_model.refresh()
 
     def select_action(self, cur_state, epsilon):
         # epsilon greedy strategy
         if np.random.uniform(low=0.0, high=1.0) > epsilon:
             # get Q(cur_state, a) for all action a
-            predictions = self.q_model.predict(cur_state)[0]
+            predictions = self.acting_model.predict(cur_state)[0]
 
             # select action with max Q value
             return np.argmax(predictions)
@@ -42,78 +67,719 @@ class DQNPolicy:
             # else return a random action
             return self.env.action_space.sample()
 
-    def update_policy(self, cur_states, actions, next_states, rewards, dones):
+    def select_actions(self, cur_states, epsilon):
+        """
+        epsilon greedy actions for a batch of states with one forward pass
+        :param cur_states: (N, state_dim) array of states
+        :param epsilon: probability of a random action, a float or an (N,) array of per state epsilons
+        :return: (N,) array of actions
+        """
+        cur_states = np.asarray(cur_states).reshape(-1, self.state_dim)
+        actions = np.argmax(self.acting_model.predict(cur_states), axis=1)
+        # each state explores on its own
+        explore = np.random.uniform(low=0.0, high=1.0, size=len(cur_states)) <= epsilon
+        actions[explore] = np.random.randint(self.action_dim, size=explore.sum())
+        return actions
+
+    def update_policy(self, cur_states, actions, next_states, rewards, dones, weights=None, gammas=None):
+        """
+        :param weights: optional importance sampling weights of the transitions, as given by a PrioritizedReplayBuffer
+        :param gammas: optional per transition discounts gamma^n of n-step transitions
+        :return: the TD errors of the transitions, to be used as their new priorities
+        """
+        discounts = self.gamma if gammas is None else gammas
         # target doesnt change when its terminal, thus multiply with (1-done)
         # target = R(st-1, at-1) + gamma * max(a') Q(st, a')
-        targets = rewards + np.multiply(1 - dones, self.gamma * (np.max(self.q_model.predict(next_states), axis=1)))
+        targets = rewards + np.multiply(1 - dones, discounts * (np.max(self.acting_model.predict(next_states), axis=1)))
 
         # expanded_targets are the Q values of all the actions for the current_states sampled
         # from the previous experience. These are the predictions
-        expanded_targets = self.q_model.predict(cur_states)
+        expanded_targets = self.acting_model.predict(cur_states)
+        td_errors = targets - expanded_targets[list(range(len(cur_states))), actions]
 
         # Prediction to be updated with the prediction+ground truth
         # We need to update the predictions to the values we want, which are the targets and then fit the model
         expanded_targets[list(range(len(cur_states))), actions] = targets
 
-        self.q_model.fit(cur_states, expanded_targets, epochs=1, verbose=False)
+        self.q_model.fit(cur_states, expanded_targets, sample_weight=weights, epochs=1, verbose=False)
+        self.acting_model.refresh()
+        return td_errors
+
+# In[]:
+
+class TorchDQNPolicy:
+    """
+    Torch version of DQNPolicy with the same constructor and select_action/update_policy API. A training step is a
+    single forward pass of the Q network on the current states, a no-grad forward pass of the target network on the
+    next states and one backward pass, without keras' predict/fit overhead. The target network is a copy of the Q
+    network synced every target_update_interval updates.
+    """
+    def __init__(self, env, lr, gamma, hidden_dim=24, input=None, output=None, target_update_interval=100):
+        self.env = env
+        if input is None:
+            self.state_dim = env.observation_space.shape[0]
+        else:
+            self.state_dim = input
+        if output is None:
+            self.action_dim = env.action_space.n
+        else:
+            self.action_dim = output
+        self.lr = lr
+        self.hidden_dim = hidden_dim
+        self.gamma = gamma
+        self.target_update_interval = target_update_interval
+
+        # build the Q network approximator, same layers as the keras model
+        self.q_model = nn.Sequential(
+            nn.Linear(self.state_dim, self.hidden_dim),
+            nn.ReLU(),
+            nn.Linear(self.hidden_dim, self.hidden_dim),
+            nn.ReLU(),
+            nn.Linear(self.hidden_dim, self.action_dim)
+        )
+        self.target_model = deepcopy(self.q_model)
+        self.target_model.requires_grad_(False)
+        self.optimizer = torch.optim.Adam(self.q_model.parameters(), lr=self.lr)
+        self.updates = 0
+        # numpy snapshot of the Q network for acting, refreshed after every update
+        self.acting_model = NumpyMLP(self.q_model)
+
+    def predict(self, states):
+        """
+        :return: Q(states, a) for all actions a as a numpy array, like keras' predict
+        """
+        return self.acting_model.predict(states)
+
+    def select_action(self, cur_state, epsilon):
+        # epsilon greedy strategy
+        if np.random.uniform(low=0.0, high=1.0) > epsilon:
+            # select action with max Q(cur_state, a)
+            return int(np.argmax(self.predict(cur_state)[0]))
+        else:
+            # else return a random action
+            return self.env.action_space.sample()
+
+    def select_actions(self, cur_states, epsilon):
+        """
+        epsilon greedy actions for a batch of states with one forward pass
+        :param cur_states: (N, state_dim) array of states
+        :param epsilon: probability of a random action, a float or an (N,) array of per state epsilons
+        :return: (N,) array of actions
+        """
+        cur_states = np.asarray(cur_states).reshape(-1, self.state_dim)
+        actions = np.argmax(self.predict(cur_states), axis=1)
+        # each state explores on its own
+        explore = np.random.uniform(low=0.0, high=1.0, size=len(cur_states)) <= epsilon
+        actions[explore] = np.random.randint(self.action_dim, size=explore.sum())
+        return actions
+
+    def update_policy(self, cur_states, actions, next_states, rewards, dones, weights=None, gammas=None):
+        """
+        :param weights: optional importance sampling weights of the transitions, as given by a PrioritizedReplayBuffer
+        :param gammas: optional per transition discounts gamma^n of n-step transitions
+        :return: the TD errors of the transitions, to be used as their new priorities
+        """
+        cur_states = torch.as_tensor(cur_states, dtype=torch.float32)
+        next_states = torch.as_tensor(next_states, dtype=torch.float32)
+        actions = torch.as_tensor(actions, dtype=torch.int64).reshape(-1, 1)
+        rewards = torch.as_tensor(rewards, dtype=torch.float32)
+        dones = torch.as_tensor(dones, dtype=torch.float32)
+        discounts = self.gamma if gammas is None else torch.as_tensor(gammas, dtype=torch.float32)
+
+        # target = R(st-1, at-1) + gamma * max(a') Q_target(st, a'), it doesnt change when its terminal
+        with torch.no_grad():
+            targets = rewards + (1 - dones) * discounts * self.target_model(next_states).max(dim=1)[0]
+        # Q(st-1, at-1) of the actions that were actually taken
+        predictions = self.q_model(cur_states).gather(1, actions).squeeze(1)
+        td_errors = targets - predictions
+
+        self.optimizer.zero_grad()
+        if weights is None:
+            loss = mse_loss(input=predictions, target=targets)
+        else:
+            loss = torch.mean(torch.as_tensor(weights, dtype=torch.float32) * torch.pow(td_errors, 2))
+        loss.backward()
+        self.optimizer.step()
+        self.acting_model.refresh()
+
+        self.updates += 1
+        if self.updates % self.target_update_interval == 0:
+            self.target_model.load_state_dict(self.q_model.state_dict())
+        return td_errors.detach().numpy()
 
 # In[]:
 
 class ReplayBuffer:
-    def __init__(self, max_size=2000):
+    """
+    Fixed capacity ring buffer of transitions. The columns are preallocated NumPy arrays, created on the first add
+    from the shape and dtype of that transition, and once max_size transitions are stored the oldest ones are
+    overwritten. Sampling only indexes into the arrays, so it costs O(sample_size) however full the buffer is.
+
+    With n_step > 1 the buffer stores n-step transitions (s_t, a_t, R_t, s_t+n, done, gamma^n) instead, where
+    R_t = r_t + gamma r_t+1 + ... + gamma^(n-1) r_t+n-1 is folded incrementally while the episode is played, and
+    sampled batches carry the per transition discount under 'gammas' for the bootstrapped TD target. Episodes have
+    to end with done=True so that the last few transitions get flushed with their shorter horizon.
+    """
+    def __init__(self, max_size=2000, n_step=1, gamma=0.99):
         self.max_size = max_size
+        self.n_step = n_step
+        self.gamma = gamma
 
-        self.cur_states = []
-        self.actions = []
-        self.next_states = []
-        self.rewards = []
-        self.dones = []
+        self.cur_states = None
+        self.actions = None
+        self.next_states = None
+        self.rewards = None
+        self.dones = None
+        self.gammas = None
+
+        # position where the next transition is written and the number of transitions stored so far
+        self._next_idx = 0
+        self._size = 0
+        # [cur_state, action, folded return, discount of the next reward] of the last n-1 steps of the episode
+        self._pending = deque()
 
     def __len__(self):
-        return len(self.cur_states)
+        return self._size
+
+    def _allocate(self, name, shape, dtype):
+        return np.empty((self.max_size,) + tuple(shape), dtype=dtype)
+
+    def _init_storage(self, cur_state, action):
+        cur_state = np.asarray(cur_state)
+        action = np.asarray(action)
+        # states are kept in float32 irrespective of what the environment returns, both keras and torch use float32
+        state_dtype = np.float32 if np.issubdtype(cur_state.dtype, np.floating) else cur_state.dtype
+        self.cur_states = self._allocate('cur_states', cur_state.shape, state_dtype)
+        self.actions = self._allocate('actions', action.shape, action.dtype)
+        self.next_states = self._allocate('next_states', cur_state.shape, state_dtype)
+        self.rewards = self._allocate('rewards', (), np.float32)
+        self.dones = self._allocate('dones', (), np.float32)
+        if self.n_step > 1:
+            self.gammas = self._allocate('gammas', (), np.float32)
 
     def add(self, cur_state, action, next_state, reward, done):
-        self.cur_states.append(cur_state)
-        self.actions.append(action)
-        self.next_states.append(next_state)
-        self.rewards.append(reward)
-        self.dones.append(done)
+        """
+        :return: the index the transition was stored at, None while an n-step transition is still being folded
+        """
+        if self.n_step == 1:
+            return self._store(cur_state, action, next_state, reward, done, self.gamma)
 
-    def sample(self, sample_size=32):
-        sample_transitions = {}
+        # every pending transition sees this reward, discounted by how many steps ago it was taken
+        for transition in self._pending:
+            transition[2] += transition[3] * reward
+            transition[3] *= self.gamma
+        # the return is folded in place, into a float of its own rather than into the caller's reward
+        self._pending.append([cur_state, action, float(reward), self.gamma])
+
+        idx = None
+        if len(self._pending) == self.n_step:
+            # the oldest one now has its full n step return and bootstraps from next_state
+            pending_state, pending_action, folded_return, discount = self._pending.popleft()
+            idx = self._store(pending_state, pending_action, next_state, folded_return, done, discount)
+        if done:
+            # the episode ended before the rest got n rewards, their returns are complete as they are
+            while self._pending:
+                pending_state, pending_action, folded_return, discount = self._pending.popleft()
+                idx = self._store(pending_state, pending_action, next_state, folded_return, done, discount)
+        return idx
+
+    def _store(self, cur_state, action, next_state, reward, done, discount):
+        if self.cur_states is None:
+            self._init_storage(cur_state, action)
+        idx = self._next_idx
+        self.cur_states[idx] = cur_state
+        self.actions[idx] = action
+        self.next_states[idx] = next_state
+        self.rewards[idx] = reward
+        self.dones[idx] = done
+        if self.gammas is not None:
+            self.gammas[idx] = discount
+        # overwrite the oldest transition once the buffer is full
+        self._next_idx = (idx + 1) % self.max_size
+        self._size = min(self._size + 1, self.max_size)
+        return idx
+
+    def _sample_indices(self, sample_size):
         if self.__len__() >= sample_size:
             # pick up only random 32 events from the memory
-            indices = np.random.choice(self.__len__(), size=sample_size)
-            sample_transitions['cur_states'] = np.array(self.cur_states)[indices]
-            sample_transitions['actions'] = np.array(self.actions)[indices]
-            sample_transitions['next_states'] = np.array(self.next_states)[indices]
-            sample_transitions['rewards'] = np.array(self.rewards)[indices]
-            sample_transitions['dones'] = np.array(self.dones)[indices]
-        else:
-            # if the current buffer size is not greater than 32 then pick up the entire memory
-            sample_transitions['cur_states'] = np.array(self.cur_states)
-            sample_transitions['actions'] = np.array(self.actions)
-            sample_transitions['next_states'] = np.array(self.next_states)
-            sample_transitions['rewards'] = np.array(self.rewards)
-            sample_transitions['dones'] = np.array(self.dones)
-        return sample_transitions
+            return np.random.randint(self.__len__(), size=sample_size)
+        # if the current buffer size is not greater than 32 then pick up the entire memory
+        return np.arange(self.__len__())
+
+    def _columns(self):
+        columns = {
+            'cur_states': self.cur_states,
+            'actions': self.actions,
+            'next_states': self.next_states,
+            'rewards': self.rewards,
+            'dones': self.dones,
+        }
+        if self.gammas is not None:
+            columns['gammas'] = self.gammas
+        return columns
+
+    def _gather(self, indices):
+        return {key: value[indices] for key, value in self._columns().items()}
+
+    def sample(self, sample_size=32):
+        return self._gather(self._sample_indices(sample_size))
 
     def sample_pytorch(self, sample_size=32):
-        sample_transitions = {}
-        if self.__len__() >= sample_size:
-            # pick up only random 32 events from the memory
-            indices = np.random.choice(self.__len__(), size=sample_size)
-            sample_transitions['cur_states'] = torch.stack(self.cur_states)[indices]
-            sample_transitions['actions'] = torch.stack(self.actions)[indices]
-            sample_transitions['next_states'] = torch.stack(self.next_states)[indices]
-            sample_transitions['rewards'] = torch.Tensor(self.rewards)[indices]
-            sample_transitions['dones'] = torch.Tensor(self.dones)[indices]
-        else:
+        sample_transitions = self.sample(sample_size)
+        # the gathered rows are fresh arrays, so wrapping them in tensors doesnt copy anything
+        return {key: torch.from_numpy(value) for key, value in sample_transitions.items()}
+
+# In[]:
+
+class TorchReplayBuffer(ReplayBuffer):
+    """
+    Same ring buffer but the columns are preallocated torch tensors, for the actor critic scripts which add tensors
+    and learn from tensors. sample_pytorch gathers the batch with index_select into output tensors which are reused
+    between calls, so a training step neither stacks the history nor allocates anything. The returned tensors are
+    therefore overwritten by the next call and must be consumed (or cloned) before sampling again.
+    """
+    def __init__(self, max_size=2000, n_step=1, gamma=0.99):
+        super(TorchReplayBuffer, self).__init__(max_size, n_step, gamma)
+        # reusable index and output tensors, keyed by the batch size they were created for
+        self._indices = {}
+        self._out = {}
+
+    def _allocate(self, name, shape, dtype):
+        return torch.empty((self.max_size,) + tuple(shape), dtype=dtype)
+
+    def _init_storage(self, cur_state, action):
+        state_dtype = torch.float32 if cur_state.is_floating_point() else cur_state.dtype
+        self.cur_states = self._allocate('cur_states', cur_state.shape, state_dtype)
+        self.actions = self._allocate('actions', action.shape, action.dtype)
+        self.next_states = self._allocate('next_states', cur_state.shape, state_dtype)
+        self.rewards = self._allocate('rewards', (), torch.float32)
+        self.dones = self._allocate('dones', (), torch.float32)
+        if self.n_step > 1:
+            self.gammas = self._allocate('gammas', (), torch.float32)
+
+    def add(self, cur_state, action, next_state, reward, done):
+        # torch doesnt assign numpy arrays into a tensor row, convert them first (a no-op for tensors)
+        return super(TorchReplayBuffer, self).add(torch.as_tensor(cur_state), torch.as_tensor(action),
+                                                  torch.as_tensor(next_state), reward, done)
+
+    def sample_pytorch(self, sample_size=32, out=None):
+        """
+        :param out: optional dict to gather the batch into instead of the buffer's own output tensors, it is filled
+        with the output tensors on the first call and reused afterwards
+        """
+        if self.__len__() < sample_size:
             # if the current buffer size is not greater than 32 then pick up the entire memory
-            sample_transitions['cur_states'] = torch.stack(self.cur_states)
-            sample_transitions['actions'] = torch.stack(self.actions)
-            sample_transitions['next_states'] = torch.stack(self.next_states)
-            sample_transitions['rewards'] = torch.Tensor(self.rewards)
-            sample_transitions['dones'] = torch.Tensor(self.dones)
+            return {key: value[:self.__len__()] for key, value in self._columns().items()}
+
+        if sample_size not in self._out:
+            self._indices[sample_size] = torch.empty(sample_size, dtype=torch.int64)
+            self._out[sample_size] = {}
+        indices = self._indices[sample_size]
+        if out is None:
+            out = self._out[sample_size]
+        if not out:
+            out.update({key: torch.empty((sample_size,) + tuple(value.shape[1:]), dtype=value.dtype)
+                        for key, value in self._columns().items()})
+        # pick up only random 32 events from the memory
+        torch.randint(self.__len__(), (sample_size,), out=indices)
+        for key, value in self._columns().items():
+            torch.index_select(value, 0, indices, out=out[key])
+        return out
 
+    def sample(self, sample_size=32):
+        return {key: value.numpy() for key, value in self.sample_pytorch(sample_size).items()}
+
+# In[]:
+
+class MemmapReplayBuffer(ReplayBuffer):
+    """
+    Ring buffer whose columns are np.memmap files in a directory, for histories of tens of millions of transitions
+    that dont fit in RAM. Sampled rows are read straight from the mapped pages, so the OS page cache decides what
+    stays in memory. The write cursor lives in a mapped file as well, which means the buffer survives the process
+    and constructing a MemmapReplayBuffer on an existing directory reopens it without reading the data, which has to
+    be done with the max_size, n_step and gamma it was created with.
+    """
+    def __init__(self, directory, max_size=10000000, n_step=1, gamma=0.99):
+        super(MemmapReplayBuffer, self).__init__(max_size, n_step, gamma)
+        self.directory = directory
+        self._cursor = None
+        if os.path.exists(os.path.join(directory, 'metadata.json')):
+            self._open()
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.dat')
+
+    def _allocate(self, name, shape, dtype):
+        return np.memmap(self._path(name), dtype=dtype, mode='w+', shape=(self.max_size,) + tuple(shape))
+
+    def _init_storage(self, cur_state, action):
+        super(MemmapReplayBuffer, self)._init_storage(cur_state, action)
+        self._cursor = np.memmap(self._path('cursor'), dtype=np.int64, mode='w+', shape=(2,))
+        metadata = {'max_size': self.max_size, 'n_step': self.n_step, 'gamma': self.gamma,
+                    'columns': {name: {'shape': list(value.shape[1:]), 'dtype': value.dtype.str}
+                                for name, value in self._columns().items()}}
+        with open(os.path.join(self.directory, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+    def _open(self):
+        with open(os.path.join(self.directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+        # the files are laid out for the settings they were created with, reopening them with others would
+        # silently store into a buffer of another size or mix returns of different lengths
+        for name in ('max_size', 'n_step', 'gamma'):
+            if metadata[name] != getattr(self, name):
+                raise ValueError('{} holds a replay buffer with {} = {}, not {}'.format(
+                    self.directory, name, metadata[name], getattr(self, name)))
+        for name, column in metadata['columns'].items():
+            setattr(self, name, np.memmap(self._path(name), dtype=np.dtype(column['dtype']), mode='r+',
+                                          shape=(self.max_size,) + tuple(column['shape'])))
+        self._cursor = np.memmap(self._path('cursor'), dtype=np.int64, mode='r+', shape=(2,))
+        self._next_idx, self._size = int(self._cursor[0]), int(self._cursor[1])
+
+    def _store(self, cur_state, action, next_state, reward, done, discount):
+        idx = super(MemmapReplayBuffer, self)._store(cur_state, action, next_state, reward, done, discount)
+        self._cursor[0] = self._next_idx
+        self._cursor[1] = self._size
+        return idx
+
+    def _sample_indices(self, sample_size):
+        # reading the rows in file order touches each page at most once and lets the kernel read ahead
+        return np.sort(super(MemmapReplayBuffer, self)._sample_indices(sample_size))
+
+    def _gather(self, indices):
+        return {key: np.asarray(value[indices]) for key, value in self._columns().items()}
+
+    def flush(self):
+        """
+        Writes the dirty pages back to the files, only needed to survive a crash of the machine itself
+        """
+        # nothing is mapped before the first transition
+        if self._cursor is None:
+            return
+        for value in self._columns().values():
+            value.flush()
+        self._cursor.flush()
+
+# In[]:
+
+class SharedReplayBuffer(ReplayBuffer):
+    """
+    Ring buffer in multiprocessing.shared_memory (python 3.8+), filled by several collector processes and sampled by
+    one learner. The capacity is split in n_writers equal slots and every writer only ever writes its own slot and its
+    own (next_idx, size) counters, so no two processes write the same memory and no lock is needed. A writer bumps
+    its size only after the row is written, hence the learner never samples a row that was not filled. Once a slot
+    wraps around the learner can race with the overwrite of the oldest row, which for replay data is harmless.
+
+    The shapes have to be known up front since every process maps the same blocks. The object pickles to the names
+    of its blocks, so it can be passed to a multiprocessing.Process as is, e.g.
+
+        buffer = SharedReplayBuffer(100000, state_shape=(4,), n_writers=4)
+        collectors = [Process(target=collect, args=(buffer, i)) for i in range(4)]
+        # in collect(buffer, i): buffer.writer_id = i; ... buffer.add(cur_state, action, next_state, reward, done)
+        # in the learner: buffer.sample_pytorch(32); and at the end buffer.close(); buffer.unlink()
+    """
+    def __init__(self, max_size, state_shape, action_shape=(), action_dtype=np.int64, n_writers=1, n_step=1,
+                 gamma=0.99):
+        super(SharedReplayBuffer, self).__init__(max_size - max_size % n_writers, n_step, gamma)
+        self.n_writers = n_writers
+        self.slot_size = self.max_size // n_writers
+        # the slot this process writes to, every collector sets its own
+        self.writer_id = 0
+        self._blocks = {}
+        self._specs = {
+            'cur_states': (tuple(state_shape), np.dtype(np.float32)),
+            'actions': (tuple(action_shape), np.dtype(action_dtype)),
+            'next_states': (tuple(state_shape), np.dtype(np.float32)),
+            'rewards': ((), np.dtype(np.float32)),
+            'dones': ((), np.dtype(np.float32)),
+        }
+        if n_step > 1:
+            self._specs['gammas'] = ((), np.dtype(np.float32))
+        for name, (shape, dtype) in self._specs.items():
+            setattr(self, name, self._allocate(name, shape, dtype))
+        # (next_idx, size) of every writer's slot
+        self._counters = self._map('counters', (n_writers, 2), np.dtype(np.int64), create=True)
+        self._counters[:] = 0
+
+    def _map(self, name, shape, dtype, create=False, block_name=None):
+        # imported here, multiprocessing.shared_memory needs python 3.8 and the rest of this module doesnt
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise ImportError('SharedReplayBuffer needs multiprocessing.shared_memory, which is new in python 3.8')
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        block = shared_memory.SharedMemory(name=block_name, create=create, size=max(nbytes, 1))
+        self._blocks[name] = block
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def _allocate(self, name, shape, dtype):
+        return self._map(name, (self.max_size,) + tuple(shape), np.dtype(dtype), create=True)
+
+    def __getstate__(self):
+        return {'max_size': self.max_size, 'n_writers': self.n_writers, 'writer_id': self.writer_id,
+                'n_step': self.n_step, 'gamma': self.gamma, 'specs': self._specs,
+                'block_names': {name: block.name for name, block in self._blocks.items()}}
+
+    def __setstate__(self, state):
+        self.max_size = state['max_size']
+        self.n_step = state['n_step']
+        self.gamma = state['gamma']
+        self.gammas = None
+        # every collector folds the n-step returns of its own episodes
+        self._pending = deque()
+        self.n_writers = state['n_writers']
+        self.slot_size = self.max_size // self.n_writers
+        self.writer_id = state['writer_id']
+        self._specs = state['specs']
+        self._blocks = {}
+        for name, (shape, dtype) in self._specs.items():
+            setattr(self, name, self._map(name, (self.max_size,) + tuple(shape), dtype,
+                                          block_name=state['block_names'][name]))
+        self._counters = self._map('counters', (self.n_writers, 2), np.dtype(np.int64),
+                                   block_name=state['block_names']['counters'])
+
+    def __len__(self):
+        return int(self._counters[:, 1].sum())
+
+    def _store(self, cur_state, action, next_state, reward, done, discount):
+        next_idx, size = self._counters[self.writer_id]
+        idx = self.writer_id * self.slot_size + next_idx
+        self.cur_states[idx] = cur_state
+        self.actions[idx] = action
+        self.next_states[idx] = next_state
+        self.rewards[idx] = reward
+        self.dones[idx] = done
+        if self.gammas is not None:
+            self.gammas[idx] = discount
+        # publish the row only once it is completely written
+        self._counters[self.writer_id, 0] = (next_idx + 1) % self.slot_size
+        self._counters[self.writer_id, 1] = min(size + 1, self.slot_size)
+        return idx
+
+    def _sample_indices(self, sample_size):
+        # snapshot the sizes once, the writers keep going while we sample
+        sizes = self._counters[:, 1].copy()
+        total = int(sizes.sum())
+        if total >= sample_size:
+            positions = np.random.randint(total, size=sample_size)
+        else:
+            positions = np.arange(total)
+        # map a position among the filled rows of all the slots to the row of the right slot
+        ends = np.cumsum(sizes)
+        slots = np.searchsorted(ends, positions, side='right')
+        return slots * self.slot_size + positions - (ends[slots] - sizes[slots])
+
+    def close(self):
+        for block in self._blocks.values():
+            block.close()
+
+    def unlink(self):
+        for block in self._blocks.values():
+            block.unlink()
+
+# In[]:
+
+class PrefetchSampler:
+    """
+    Draws the next batches of a replay buffer on a background thread and hands them over through a queue bounded to
+    prefetch batches, so that assembling a batch overlaps with the forward and backward pass on the previous one.
+    The price is that a batch can miss the last prefetch transitions added. Until the buffer holds sample_size
+    transitions the batches are drawn synchronously, as the buffer would return them.
+
+    Transitions and priority updates have to go through the sampler, which guards the buffer with a lock so that
+    the thread never reads a row while it is written. With a TorchReplayBuffer the batches are gathered into
+    prefetch + 2 rotating sets of output tensors, hence a batch stays valid until the next call to sample only.
+    """
+    def __init__(self, replay_buffer, sample_size=32, prefetch=4, pytorch=True):
+        self.replay_buffer = replay_buffer
+        self.sample_size = sample_size
+        self.pytorch = pytorch
+        self.lock = threading.Lock()
+        # one set of outputs for each batch in the queue, the one being used and the one being drawn
+        self._outs = [{} for _ in range(prefetch + 2)]
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        # the exception the thread stopped on, raised again by sample()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, cur_state, action, next_state, reward, done):
+        with self.lock:
+            idx = self.replay_buffer.add(cur_state, action, next_state, reward, done)
+        if len(self.replay_buffer) >= self.sample_size:
+            self._ready.set()
+        return idx
+
+    def update_priorities(self, indices, td_errors):
+        with self.lock:
+            self.replay_buffer.update_priorities(indices, td_errors)
+
+    def _draw(self, out):
+        if isinstance(self.replay_buffer, TorchReplayBuffer):
+            sample_transitions = self.replay_buffer.sample_pytorch(self.sample_size, out=out)
+            if not self.pytorch:
+                sample_transitions = {key: value.numpy() for key, value in sample_transitions.items()}
+            return sample_transitions
+        if self.pytorch:
+            return self.replay_buffer.sample_pytorch(self.sample_size)
+        return self.replay_buffer.sample(self.sample_size)
+
+    def _put(self, item):
+        # block while the queue is full, but keep an eye on close()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        self._ready.wait()
+        slot = 0
+        while not self._stop.is_set():
+            try:
+                with self.lock:
+                    sample_transitions = self._draw(self._outs[slot])
+            except Exception as error:
+                # hand the error over to sample() instead of leaving it waiting on a queue nobody fills anymore
+                self.error = error
+                self._put(None)
+                return
+            slot = (slot + 1) % len(self._outs)
+            self._put(sample_transitions)
+
+    def sample(self):
+        if not self._ready.is_set():
+            with self.lock:
+                return self._draw(None)
+        if self.error is not None and self._queue.empty():
+            raise RuntimeError('the prefetch thread failed') from self.error
+        sample_transitions = self._queue.get()
+        if sample_transitions is None:
+            raise RuntimeError('the prefetch thread failed') from self.error
+        return sample_transitions
+
+    def close(self):
+        self._stop.set()
+        # wake the thread up in case the buffer never filled
+        self._ready.set()
+        self._thread.join()
+
+# In[]:
+
+class SumTree:
+    """
+    Binary segment tree over max_size leaves where every node holds the sum of its children. Updating leaves and
+    finding the leaf where a prefix sum falls are both O(log N), and both work on whole batches of indices at once.
+    """
+    def __init__(self, max_size, neutral=0.0):
+        # round the capacity up to a power of two so that every leaf is at the same depth
+        self.capacity = 1
+        while self.capacity < max_size:
+            self.capacity *= 2
+        self.neutral = neutral
+        self.tree = np.full(2 * self.capacity, neutral, dtype=np.float64)
+
+    def _combine(self, left, right):
+        return left + right
+
+    def update(self, indices, values):
+        nodes = np.asarray(indices) + self.capacity
+        self.tree[nodes] = values
+        # walk up one level at a time, recomputing every parent touched by this batch
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self._combine(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+            nodes = np.unique(nodes // 2)
+
+    def root(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+    def find_prefixsum_idx(self, prefixes):
+        """
+        :param prefixes: array of values in [0, root()]
+        :return: for every prefix the highest leaf index i such that sum(leaves[:i]) <= prefix
+        """
+        prefixes = np.array(prefixes, dtype=np.float64)
+        nodes = np.ones(prefixes.shape, dtype=np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            go_right = prefixes > self.tree[left]
+            prefixes -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.capacity
+
+
+class MinTree(SumTree):
+    def __init__(self, max_size):
+        super(MinTree, self).__init__(max_size, neutral=np.inf)
+
+    def _combine(self, left, right):
+        return np.minimum(left, right)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Proportional prioritized experience replay (Schaul et al.). A transition is sampled with probability
+    p_i^alpha / sum_k p_k^alpha where p_i is its last absolute TD error, and the sampled batch carries the importance
+    sampling weights (N * P(i))^-beta / max_j (N * P(j))^-beta that correct for the non uniform sampling, along with
+    the indices needed to update the priorities once the new TD errors are known.
+    """
+    def __init__(self, max_size=2000, alpha=0.6, beta=0.4, epsilon=1e-6, n_step=1, gamma=0.99):
+        super(PrioritizedReplayBuffer, self).__init__(max_size, n_step, gamma)
+        self.alpha = alpha
+        # beta is usually annealed towards 1 over the training, the caller can simply overwrite it
+        self.beta = beta
+        # epsilon makes sure no transition is ever starved of being sampled
+        self.epsilon = epsilon
+        self.sum_tree = SumTree(max_size)
+        self.min_tree = MinTree(max_size)
+        self.max_priority = 1.0
+
+    def _store(self, cur_state, action, next_state, reward, done, discount):
+        idx = super(PrioritizedReplayBuffer, self)._store(cur_state, action, next_state, reward, done, discount)
+        # new transitions get the highest priority seen so far so that each of them is replayed at least once
+        priority = self.max_priority ** self.alpha
+        self.sum_tree.update([idx], priority)
+        self.min_tree.update([idx], priority)
+        return idx
+
+    def _sample_indices(self, sample_size):
+        if self.__len__() < sample_size:
+            return np.arange(self.__len__())
+        # stratified sampling, one prefix sum drawn uniformly from each of sample_size equal segments of the total
+        segment = self.sum_tree.root() / sample_size
+        prefixes = (np.arange(sample_size) + np.random.uniform(size=sample_size)) * segment
+        indices = self.sum_tree.find_prefixsum_idx(prefixes)
+        # guard against floating point round off picking an empty leaf
+        return np.minimum(indices, self.__len__() - 1)
+
+    def _importance_weights(self, indices):
+        total = self.sum_tree.root()
+        probabilities = self.sum_tree[indices] / total
+        max_weight = (self.__len__() * self.min_tree.root() / total) ** (-self.beta)
+        return ((self.__len__() * probabilities) ** (-self.beta) / max_weight).astype(np.float32)
+
+    def sample(self, sample_size=32):
+        indices = self._sample_indices(sample_size)
+        sample_transitions = self._gather(indices)
+        sample_transitions['weights'] = self._importance_weights(indices)
+        sample_transitions['indices'] = indices
         return sample_transitions
+
+    def update_priorities(self, indices, td_errors):
+        """
+        :param indices: the indices returned along with the sampled transitions
+        :param td_errors: the new TD errors of those transitions
+        """
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)).reshape(-1) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.update(indices, priorities ** self.alpha)
+        self.min_tree.update(indices, priorities ** self.alpha)
@@ -1,13 +1,14 @@
 import torch
 import torch.optim as optim
-from dqn import ReplayBuffer
+from dqn import TorchReplayBuffer
 # from torch.distributions import Categorical
 from torch.nn.functional import mse_loss
 import numpy as np
 # from torch.optim.lr_scheduler import StepLR
 # from torch.optim.lr_scheduler import ReduceLROnPlateau
-from actor_critic_structure import Actor, Critic
-from copy import deepcopy
+from actor_critic_structure import Actor, Critic, ActorCritic, TargetNetwork, EpisodeBuffer, evaluate_episode, \
+    acla_repeat_counts, repeated_actor_update
+from numpy_inference import NumpyMLP
 from env_definition import RandomVariable
 # import json
 
@@ -56,21 +57,45 @@ penalty = -1
 lowest = -10
 
 env = RandomVariable(highest=highest, intermediate=intermediate, penalty=penalty, lowest=lowest)
-# The actor can just output an action, since the action space is continuous now
-actor = Actor(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24, continuous=True)
-
-# Approximating the Value function
-critic = Critic(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24)
+# share the first hidden layers between the actor and the critic, acting and evaluating the current state is then
+# a single forward pass
+shared_trunk = False
+if shared_trunk:
+    actor_critic = ActorCritic(input_size=env.observation_space.shape[0],
+                               output_size=1, hidden_size=24, continuous=True)
+    actor, critic = actor_critic.actor, actor_critic.critic
+else:
+    # The actor can just output an action, since the action space is continuous now
+    actor = Actor(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24, continuous=True)
+
+    # Approximating the Value function
+    critic = Critic(input_size=env.observation_space.shape[0], output_size=1, hidden_size=24)
 
 # critic_old is used for fixing the target in learning the V function
-critic_old = deepcopy(critic)
+critic_old = TargetNetwork(critic)
 
 copy_epoch = 100
 
 optimizer_algo = 'batch'
+# with the sgd actor update, apply the ceil(TD error / std) repeated updates of the actions with a positive TD error
+# at the end of the episode, in a single step weighted by the number of repeats instead of one step per repeat
+batched_repeats = False
+# take max(repeats) steps instead, the j-th one on the actions with more than j repeats left, which follows the
+# repeated updates closely with plain SGD (the momentum of the sgd actor optimizer makes both differ a bit more)
+exact_repeats = False
+# with the batch update nothing is learnt during the episode, so V(s_t) and the targets are computed for the whole
+# episode in two batched forward passes at its end instead of once per timestep, with the same result
+deferred_evaluation = optimizer_algo == 'batch' or batched_repeats
+# per episode storage of the transitions, grown if an episode is longer
+episode = EpisodeBuffer(max_episode_len=500)
 
 # Critic is always optimized in batch
-critic_optimizer = optim.Adam(critic.parameters(), lr=critic_learning_rate)
+if shared_trunk:
+    # the trunk is only trained by the actor's optimizer, it then has a single optimizer state and step. The critic
+    # is fitted at the end of the episode only and its loss just moves the value head
+    critic_optimizer = optim.Adam(critic.head_parameters(), lr=critic_learning_rate)
+else:
+    critic_optimizer = optim.Adam(critic.parameters(), lr=critic_learning_rate)
 
 if optimizer_algo == 'sgd':
     actor_optimizer = optim.SGD(actor.parameters(), lr=actor_learning_rate, momentum=0.8, nesterov=True)
@@ -89,7 +114,7 @@ running_loss2_mean = 0
 loss1_history = []
 loss2_history = []
 # initialize policy and replay buffer
-replay_buffer = ReplayBuffer()
+replay_buffer = TorchReplayBuffer()
 actor_replay_buffer = ActorReplayBuffer()
 
 beta = 0.001  # beta is the momentum in variance updates of TD Error
@@ -99,10 +124,12 @@ running_variance = 1
 # In[]:
 
 
-def update_critic(critic_old, cur_states, actions, next_states, rewards, dones):
+def update_critic(critic_old, cur_states, actions, next_states, rewards, dones, gammas=None):
 
+    # n-step transitions carry their own discount gamma^n, one step transitions use gamma
+    discounts = gamma if gammas is None else gammas
     # target doesnt change when its terminal, thus multiply with (1-done)
-    targets = rewards + torch.mul(1 - dones, gamma*critic_old(next_states).squeeze(-1) )
+    targets = rewards + torch.mul(1 - dones, discounts*critic_old.evaluate(next_states).squeeze(-1) )
     # expanded_targets are the Q values of all the actions for the current_states sampled
     # from the previous experience. These are the predictions
     expanded_targets = critic(cur_states).squeeze(-1)
@@ -120,7 +147,7 @@ for episode_i in range(train_episodes):
 
     # make a copy every copy_epoch epochs
     if episode_i % copy_epoch == 0:
-        critic_old = deepcopy(critic)
+        critic_old.hard_update()
 
     episode_reward = 0.0
     episode_timestep = 0
@@ -130,54 +157,69 @@ for episode_i in range(train_episodes):
 
     actors_output_list = torch.Tensor()
     action_target_list = torch.Tensor()
-    u_value_list = torch.Tensor()
-    target_list = torch.Tensor()
     reward_list = list()
+    episode.reset()
 
     while not done:
-        action, _ = actor.select_action(cur_state)
+        if deferred_evaluation:
+            # the actor and critic outputs are recomputed in a batch at the end of the episode, acting needs no graph
+            with torch.no_grad():
+                action, _ = actor.select_action(cur_state)
+        elif shared_trunk:
+            action, _, u_value = actor_critic.select_action(cur_state)
+        else:
+            action, _ = actor.select_action(cur_state)
+            u_value = critic(cur_state)
 
         # take action in the environment
         next_state, reward, done, info = env.step(action.item())
         next_state = torch.Tensor(next_state)
         reward_list.append(reward)
+        episode.add(states=cur_state, actions=action, next_states=next_state, rewards=reward, dones=done)
 
-        u_value = critic(cur_state)
-        u_value_list = torch.cat([u_value_list, u_value])
-
-        # Update parameters of critic by TD(0)
-        target = reward + gamma * (1-done) * critic_old(next_state)
-        target_list = torch.cat([target_list, target])
+        if not deferred_evaluation:
+            # Update parameters of critic by TD(0)
+            target = reward + gamma * (1-done) * critic_old.evaluate(next_state)
 
         # replay_buffer.add(cur_state, action, next_state, reward, done)
         # sample_transitions = replay_buffer.sample_pytorch(sample_size=32)
         # # update the critic's q approximation using the sampled transitions
         # running_loss1_mean += update_critic(critic_old, **sample_transitions)
 
-        if target - u_value > 0:
-            if optimizer_algo == 'sgd':
-                # Update parameters of actor by ACLA
-                td_error = target - u_value
-                running_variance = running_variance*(1-beta) + beta*torch.pow(td_error, 2)
-                # no. of updates to this action should be equal to floor(TD Error / std_dev of TD error) as per the
-                # original paper in Hasselt and Wiering
-                for el in range(int(torch.ceil(td_error / torch.sqrt(running_variance)))):
-                    actor_optimizer.zero_grad()
-                    loss2 = mse_loss(input=action.detach(), target=actor(cur_state)) # the implementation for mse
-                    # is (input - target)^2
-                    loss2.backward()
-                    actor_optimizer.step()
-                    running_loss2_mean += loss2.item()
-
-            elif optimizer_algo == 'batch':
-                action_target_list = torch.cat([action_target_list, action])
-                actors_output_list = torch.cat([actors_output_list, actor(cur_state)])
-                # log_prob_list = torch.cat([log_prob_list, log_prob.reshape(-1)])
+        # with the batch update the actions with a positive TD error are picked from the episode at its end
+        if optimizer_algo == 'sgd' and not batched_repeats and target - u_value > 0:
+            # Update parameters of actor by ACLA
+            td_error = target - u_value
+            running_variance = running_variance*(1-beta) + beta*torch.pow(td_error, 2)
+            # no. of updates to this action should be equal to floor(TD Error / std_dev of TD error) as per the
+            # original paper in Hasselt and Wiering
+            for el in range(int(torch.ceil(td_error / torch.sqrt(running_variance)))):
+                actor_optimizer.zero_grad()
+                loss2 = mse_loss(input=action.detach(), target=actor(cur_state)) # the implementation for mse
+                # is (input - target)^2
+                loss2.backward()
+                actor_optimizer.step()
+                running_loss2_mean += loss2.item()
 
         episode_reward += reward
         episode_timestep += 1
         cur_state = next_state
 
+    # the critic is only trained at the end of the episode, so these are the values of every timestep
+    u_value_list, target_list = evaluate_episode(critic, critic_old, episode['states'], episode['next_states'],
+                                                 episode['rewards'], episode['dones'], gamma)
+    if optimizer_algo == 'sgd' and batched_repeats:
+        # all the repeated updates of the episode, the actions and TD errors are the ones of the per step update
+        repeat_counts, running_variance = acla_repeat_counts(target_list - u_value_list, running_variance, beta)
+        running_loss2_mean += repeated_actor_update(actor, actor_optimizer, episode['states'], episode['actions'],
+                                                    repeat_counts, exact=exact_repeats)
+    if optimizer_algo == 'batch':
+        # the actions with a positive TD error are the targets of the actor, the actor hasnt changed during the
+        # episode so its outputs for them are recomputed in one batch
+        positive = (target_list - u_value_list).detach() > 0
+        action_target_list = episode['actions'][positive].squeeze(-1)
+        actors_output_list = actor(episode['states'][positive]).squeeze(-1)
+
     critic_optimizer.zero_grad()
     u_value_list_copy = (u_value_list - u_value_list.mean()) / u_value_list.std()
     target_list_copy = (target_list - target_list.mean()) / target_list.std()
@@ -236,6 +278,8 @@ axes[2].plot(loss2_history)
 
 # In[]:
 
+# act with a numpy snapshot of the trained actor
+numpy_actor = NumpyMLP(actor)
 cur_state = env.reset()
 total_step = 0
 total_reward = 0.0
@@ -245,7 +289,7 @@ y2 = list()
 x = list()
 while not done:
     x.append(cur_state[0])
-    action, probs = actor.select_action(torch.Tensor(cur_state))
+    action = numpy_actor.select_action(cur_state)
     y1.append(cur_state[1]+action.item())
     y2.append(cur_state[1])
     next_state, reward, done, info = env.step(action.item())
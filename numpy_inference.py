@@ -0,0 +1,113 @@
+"""
+Pure NumPy copies of the small MLPs, for acting and evaluation. Pushing a single state through keras or torch
+costs tens to hundreds of microseconds of framework overhead while the matmuls of a 4->24->24->2 network take
+well under one, so the acting loops run on a snapshot of the weights which is refreshed whenever the learner
+updates the network.
+"""
+
+import numpy as np
+import torch.nn as nn
+from scipy.special import ndtr, ndtri
+
+
+class NumpyMLP:
+    """
+    Snapshot of an Actor, Critic, QCritic, a torch nn.Sequential of Linear layers and activations, or a keras
+    Sequential of Dense layers. Call refresh() after the source network is updated, it copies the weights into
+    the arrays of the snapshot without allocating new ones.
+    """
+    def __init__(self, model):
+        self.model = model
+        # the Actor maps its sigmoid output to -1 to 1 for continuous action spaces
+        self.continuous = getattr(model, 'continuous', False)
+        # list of (operation, weight, bias), weight and bias are None for the activations
+        self.layers = []
+        # the layers holding the weights, in the order of self.layers' linear operations
+        self._sources = []
+        if isinstance(model, nn.Module):
+            for module in model.modules():
+                if isinstance(module, nn.Linear):
+                    self._sources.append(module)
+                    self.layers.append(('linear', module.weight.detach().numpy().T.copy(),
+                                        module.bias.detach().numpy().copy()))
+                elif isinstance(module, nn.ReLU):
+                    self.layers.append(('relu', None, None))
+                elif isinstance(module, nn.Sigmoid):
+                    self.layers.append(('sigmoid', None, None))
+                elif isinstance(module, nn.Softmax):
+                    self.layers.append(('softmax', None, None))
+                elif isinstance(module, nn.Tanh):
+                    self.layers.append(('tanh', None, None))
+                elif isinstance(module, nn.Dropout):
+                    # dropout is the identity when acting
+                    continue
+                elif not list(module.children()):
+                    raise ValueError('cannot export a {} layer to numpy'.format(type(module).__name__))
+        else:
+            # keras, every Dense layer is a linear operation followed by its activation
+            for layer in model.layers:
+                weight, bias = layer.get_weights()
+                self._sources.append(layer)
+                self.layers.append(('linear', np.array(weight, dtype=np.float32), np.array(bias, dtype=np.float32)))
+                activation = layer.get_config()['activation']
+                if activation != 'linear':
+                    self.layers.append((activation, None, None))
+
+    def refresh(self):
+        linear_layers = [layer for layer in self.layers if layer[0] == 'linear']
+        for source, (_, weight, bias) in zip(self._sources, linear_layers):
+            if isinstance(source, nn.Linear):
+                np.copyto(weight, source.weight.detach().numpy().T)
+                np.copyto(bias, source.bias.detach().numpy())
+            else:
+                source_weight, source_bias = source.get_weights()
+                np.copyto(weight, source_weight)
+                np.copyto(bias, source_bias)
+
+    def predict(self, states):
+        """
+        :param states: a single state or an (N, state_dim) array of states
+        :return: the output of the network for the states
+        """
+        out = np.asarray(states, dtype=np.float32)
+        for operation, weight, bias in self.layers:
+            if operation == 'linear':
+                out = np.dot(out, weight) + bias
+            elif operation == 'relu':
+                out = np.maximum(out, 0)
+            elif operation == 'sigmoid':
+                out = 1 / (1 + np.exp(-out))
+            elif operation == 'tanh':
+                out = np.tanh(out)
+            elif operation == 'softmax':
+                out = np.exp(out - out.max(axis=-1, keepdims=True))
+                out /= out.sum(axis=-1, keepdims=True)
+            else:
+                raise ValueError('unknown activation {}'.format(operation))
+        # transform the output between -1 to 1 for continuous action spaces
+        if self.continuous:
+            out = 2 * out - 1
+        return out
+
+    __call__ = predict
+
+    def select_action(self, current_state, scale=0.1):
+        """
+        Same exploration as Actor.select_action, without the log probability since nothing is learnt from it
+        :param current_state: a single state or an (N, state_dim) array of states
+        :param scale: standard deviation of the gaussian exploration for continuous actions
+        :return: the chosen action(s)
+        """
+        out = self.predict(current_state)
+        if not self.continuous:
+            # out is the probability of each of the discrete actions, sample one of them per state
+            uniform = np.random.uniform(size=out.shape[:-1] + (1,))
+            return (np.cumsum(out, axis=-1) < uniform).sum(axis=-1).clip(max=out.shape[-1] - 1)
+        # gaussian exploration around the predicted action truncated to -1 to +1, sampled by inverse CDF
+        out = out.astype(np.float64)
+        cdf_low = ndtr((-1 - out) / scale)
+        cdf_high = ndtr((1 - out) / scale)
+        p = cdf_low + np.random.uniform(size=out.shape) * (cdf_high - cdf_low)
+        explored_action = np.clip(out + scale * ndtri(p), -1, 1)
+        # float32 like the torch actions, the action space of the environment checks the dtype
+        return explored_action.astype(np.float32)
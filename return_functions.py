@@ -0,0 +1,108 @@
+"""
+Discounted returns and advantages of whole episodes in one reverse pass. The reward-to-go G_t = r_t + gamma * G_t+1
+and the GAE advantage A_t = delta_t + gamma * lambda * A_t+1 are first order linear recurrences run backwards in time,
+so they are computed with scipy.signal.lfilter over the reversed sequence instead of summing the discounted tail of
+every timestep. Works on lists, NumPy arrays and torch tensors, for a single episode of shape (T,) or a batch of padded
+episodes of shape (N, T) with a mask of the valid timesteps.
+"""
+
+import numpy as np
+import torch
+from scipy.signal import lfilter
+
+
+def _discounted_cumsum(rewards, gamma):
+    # y[t] = x[t] + gamma * y[t+1] along the last axis
+    return np.flip(lfilter([1], [1, -gamma], np.flip(rewards, axis=-1), axis=-1), axis=-1)
+
+
+def _to_numpy(values):
+    # returns and advantages are constants of the losses, they are computed without a graph
+    if isinstance(values, torch.Tensor):
+        return values.detach().cpu().numpy().astype(np.float64)
+    return np.asarray(values, dtype=np.float64)
+
+
+def _like(values, like):
+    # back to the type of the input
+    if isinstance(like, torch.Tensor):
+        return torch.as_tensor(values.copy(), dtype=like.dtype if like.is_floating_point() else torch.float32,
+                               device=like.device)
+    return values.copy()
+
+
+def discounted_returns(rewards, gamma, mask=None):
+    """
+    :param rewards: (T,) rewards of an episode, or (N, T) rewards of N episodes padded to the same length T
+    :param gamma: the discount factor
+    :param mask: optional (N, T) mask, 1 for the timesteps of the episodes and 0 for the padding after their end
+    :return: the return of every timestep, same type and shape as rewards (a float array for a list), 0 on the padding
+    """
+    values = _to_numpy(rewards)
+    if mask is not None:
+        mask = _to_numpy(mask)
+        # the padding is after the end of each episode, zeroing it leaves the returns of the episode unchanged
+        values = values * mask
+    returns = _discounted_cumsum(values, gamma)
+    if mask is not None:
+        returns = returns * mask
+    return _like(returns, rewards)
+
+
+def lambda_advantages(td_errors, dones, gamma, lam, mask=None):
+    """
+    GAE advantages A_t = delta_t + gamma * lambda * (1-done_t) * A_t+1 from the TD errors of the timesteps. lam=0 gives
+    the TD errors back, lam=1 the Monte Carlo return minus the value.
+    :param td_errors: (T,) or (N, T) TD errors delta_t = r_t + gamma * (1-done_t) * V(s_t+1) - V(s_t)
+    :param dones: done flags of the same shape, an episode ending before the last column stops the sum there
+    :param gamma: the discount factor
+    :param lam: the lambda of GAE, trading the variance of long returns for the bias of the critic
+    :param mask: optional (N, T) mask, 1 for the timesteps of the episodes and 0 for the padding after their end
+    :return: the advantages, same type and shape as td_errors, 0 on the padding
+    """
+    deltas = _to_numpy(td_errors)
+    discounts = gamma * lam * (1 - _to_numpy(dones))
+    if mask is not None:
+        mask = _to_numpy(mask)
+        deltas = deltas * mask
+    if np.all(discounts[..., :-1] == gamma * lam):
+        # no episode ends before the last column, the discount is the same everywhere
+        advantages = _discounted_cumsum(deltas, gamma * lam)
+    else:
+        advantages = np.empty_like(deltas)
+        running = np.zeros(deltas.shape[:-1])
+        for t in reversed(range(deltas.shape[-1])):
+            running = deltas[..., t] + discounts[..., t] * running
+            advantages[..., t] = running
+    if mask is not None:
+        advantages = advantages * mask
+    return _like(advantages, td_errors)
+
+
+def generalized_advantages(rewards, values, next_values, dones, gamma, lam, mask=None):
+    """
+    GAE advantages and the lambda-returns to train the critic on, for whole episodes
+    :param rewards: (T,) or (N, T) rewards
+    :param values: V(s_t) of the same shape
+    :param next_values: V(s_t+1) of the same shape
+    :param dones: done flags of the same shape
+    :param gamma: the discount factor
+    :param lam: the lambda of GAE
+    :param mask: optional (N, T) mask of the valid timesteps of padded episodes
+    :return: the advantages and the value targets A_t + V(s_t), same type and shape as rewards
+    """
+    td_errors = _to_numpy(rewards) + gamma * (1 - _to_numpy(dones)) * _to_numpy(next_values) - _to_numpy(values)
+    advantages = lambda_advantages(td_errors, dones, gamma, lam, mask=mask)
+    value_targets = advantages + _to_numpy(values)
+    if mask is not None:
+        value_targets = value_targets * _to_numpy(mask)
+    return _like(advantages, rewards), _like(value_targets, rewards)
+
+
+def first_return(rewards, gamma):
+    """
+    :param rewards: rewards of an episode from some timestep on
+    :param gamma: the discount factor
+    :return: the discounted return of the first of these rewards
+    """
+    return float(np.dot(np.power(gamma, np.arange(len(rewards))), np.asarray(rewards, dtype=np.float64)))
@@ -1,4 +1,5 @@
 import numpy as np
+from return_functions import first_return
 
 
 def describe_policy_matrix(matrix, env):
@@ -20,13 +21,7 @@ def get_return(state_list, gamma):
     :param gamma: the discount factor
     :return: the return value for that state_list
     """
-    return_value = 0
-    counter = 0
-    for visit in state_list:
-        reward = visit[2]
-        return_value += reward * np.power(gamma, counter)
-        counter += 1
-    return return_value
+    return first_return([visit[2] for visit in state_list], gamma)
 
 
 def update_policy(episode_list, policy_matrix, state_action_matrix):
@@ -0,0 +1,239 @@
+"""
+Gym environments stepped in worker processes. Every worker holds a few of the environments, the observations,
+rewards, done flags and actions are exchanged through arrays in shared memory and the pipes only carry the commands
+and the info dicts, so the learner reads a ready (num_envs, obs_dim) batch instead of unpickling one observation per
+environment. step() runs all the workers in lockstep. With asynchronous=True, step_async/step_wait hand back the
+environments of whichever workers finish first, so a slow worker doesnt hold up the others.
+
+    env = SubprocVectorEnv([partial(gym.make, 'CartPole-v1') for _ in range(8)], envs_per_worker=2)
+    states = env.reset()
+    actions = numpy_actor.select_action(states)
+    next_states, rewards, dones, infos = env.step(actions)
+    ...
+    env.close()
+"""
+
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import traceback
+import numpy as np
+from gym import spaces
+
+
+def _shared_array(context, shape, dtype):
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+    return context.RawArray('b', max(nbytes, 1)), tuple(shape), dtype
+
+
+def _as_numpy(shared):
+    raw, shape, dtype = shared
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape, dtype=np.int64))).reshape(shape)
+
+
+def _worker(env_fns, start, pipe, parent_pipe, shared, discrete, auto_reset):
+    # the parent end is inherited with fork, closing it lets the worker see the parent going away
+    parent_pipe.close()
+    observations, rewards, dones, actions = (_as_numpy(array) for array in shared)
+    end = start + len(env_fns)
+    envs = []
+    try:
+        envs = [env_fn() for env_fn in env_fns]
+        while True:
+            command, data = pipe.recv()
+            if command == 'step':
+                infos = []
+                for i, env in enumerate(envs, start):
+                    action = int(actions[i]) if discrete else actions[i].copy()
+                    observation, reward, done, info = env.step(action)
+                    if done and auto_reset:
+                        # the next step of this env is the first of its next episode
+                        info['terminal_observation'] = observation
+                        observation = env.reset()
+                    observations[i] = observation
+                    rewards[i] = reward
+                    dones[i] = done
+                    infos.append(info)
+                pipe.send(('ok', infos))
+            elif command == 'reset':
+                for i, env in enumerate(envs, start):
+                    observations[i] = env.reset()
+                pipe.send(('ok', None))
+            elif command == 'seed':
+                pipe.send(('ok', [env.seed(None if data is None else data + i) for i, env in enumerate(envs, start)]))
+            elif command == 'call':
+                name, args, kwargs = data
+                pipe.send(('ok', [getattr(env, name)(*args, **kwargs) for env in envs]))
+            elif command == 'close':
+                pipe.send(('ok', None))
+                break
+            else:
+                raise ValueError('unknown command {}'.format(command))
+    except (KeyboardInterrupt, EOFError):
+        pass
+    except Exception:
+        pipe.send(('error', 'environments {} to {}:\n{}'.format(start, end - 1, traceback.format_exc())))
+    finally:
+        for env in envs:
+            env.close()
+        pipe.close()
+
+
+class SubprocVectorEnv:
+    """
+    len(env_fns) environments in len(env_fns) / envs_per_worker worker processes. env_fns are callables creating
+    the environments, they have to be picklable with the spawn start method, e.g. functools.partial(gym.make, id).
+    With auto_reset a finished environment is reset by its worker right away, its last observation is in
+    info['terminal_observation'] and the observation returned is the first one of its next episode.
+    """
+    def __init__(self, env_fns, envs_per_worker=1, asynchronous=False, auto_reset=True, context=None):
+        self.num_envs = len(env_fns)
+        self.envs_per_worker = envs_per_worker
+        self.asynchronous = asynchronous
+        # the spaces of the environments, from a throwaway instance
+        env = env_fns[0]()
+        self.observation_space, self.action_space = env.observation_space, env.action_space
+        env.close()
+        discrete = isinstance(self.action_space, spaces.Discrete)
+
+        context = mp.get_context(context)
+        shared = (
+            _shared_array(context, (self.num_envs,) + self.observation_space.shape, self.observation_space.dtype),
+            _shared_array(context, (self.num_envs,), np.float64),
+            _shared_array(context, (self.num_envs,), np.bool_),
+            _shared_array(context, (self.num_envs,) + (() if discrete else self.action_space.shape),
+                          np.int64 if discrete else self.action_space.dtype),
+        )
+        self.observations, self.rewards, self.dones, self.actions = (_as_numpy(array) for array in shared)
+
+        # the envs of worker k are envs_per_worker * k to envs_per_worker * (k+1) - 1
+        self.pipes = []
+        self.processes = []
+        for start in range(0, self.num_envs, envs_per_worker):
+            pipe, worker_pipe = context.Pipe()
+            process = context.Process(target=_worker, daemon=True,
+                                      args=(env_fns[start:start + envs_per_worker], start, worker_pipe, pipe, shared,
+                                            discrete, auto_reset))
+            process.start()
+            worker_pipe.close()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+        self.num_workers = len(self.processes)
+        # workers stepping, waiting to be collected by step_wait
+        self._pending = set()
+        self.closed = False
+
+    def _env_ids(self, worker):
+        return np.arange(worker * self.envs_per_worker, min((worker + 1) * self.envs_per_worker, self.num_envs))
+
+    def _receive(self, worker):
+        status, result = self.pipes[worker].recv()
+        if status == 'error':
+            self.close(terminate=True)
+            raise RuntimeError('a worker of the vector env failed in ' + result)
+        return result
+
+    def _broadcast(self, command, data=None):
+        assert not self._pending, 'the vector env is still stepping, call step_wait first'
+        for pipe in self.pipes:
+            pipe.send((command, data))
+        return [self._receive(worker) for worker in range(self.num_workers)]
+
+    def reset(self):
+        """
+        :return: (num_envs,) + observation shape array of the first observations
+        """
+        self._broadcast('reset')
+        return self.observations.copy()
+
+    def seed(self, seed=None):
+        # the i-th environment gets seed + i
+        return [seed for seeds in self._broadcast('seed', seed) for seed in seeds]
+
+    def call(self, name, *args, **kwargs):
+        """
+        Calls a method of every environment in its worker, e.g. env.call('render', mode='rgb_array')
+        :return: the list of the results, in the order of the environments
+        """
+        return [result for results in self._broadcast('call', (name, args, kwargs)) for result in results]
+
+    def step_async(self, actions, env_ids=None):
+        """
+        Starts stepping the environments of env_ids, which have to be all the environments of their workers as
+        returned by step_wait
+        :param actions: the actions of the environments of env_ids, in the same order
+        :param env_ids: the environments to step, all of them by default
+        """
+        if env_ids is None:
+            env_ids = np.arange(self.num_envs)
+        env_ids = np.asarray(env_ids)
+        self.actions[env_ids] = np.asarray(actions).reshape(self.actions[env_ids].shape)
+        workers = np.unique(env_ids // self.envs_per_worker)
+        assert sum(len(self._env_ids(worker)) for worker in workers) == len(env_ids), \
+            'a worker steps all its environments, env_ids has to hold all of them'
+        for worker in workers:
+            assert worker not in self._pending, 'worker {} is already stepping'.format(worker)
+            self.pipes[worker].send(('step', None))
+            self._pending.add(worker)
+
+    def step_wait(self, timeout=None):
+        """
+        Collects stepping workers, all of them in lockstep and the ones which are done within timeout with
+        asynchronous=True (at least one if timeout is None)
+        :return: the ids of the environments collected, their observations, rewards, done flags and info dicts
+        """
+        if not self._pending:
+            return np.zeros(0, dtype=np.int64), self.observations[:0], self.rewards[:0], self.dones[:0], []
+        if self.asynchronous:
+            ready = wait([self.pipes[worker] for worker in self._pending], timeout)
+            workers = sorted(self.pipes.index(pipe) for pipe in ready)
+        else:
+            workers = sorted(self._pending)
+        infos = []
+        for worker in workers:
+            infos.extend(self._receive(worker))
+            self._pending.discard(worker)
+        env_ids = np.concatenate([self._env_ids(worker) for worker in workers]) if workers \
+            else np.zeros(0, dtype=np.int64)
+        return env_ids, self.observations[env_ids], self.rewards[env_ids], self.dones[env_ids], infos
+
+    def step(self, actions):
+        """
+        Steps all the environments in lockstep
+        :param actions: (num_envs,) + action shape actions
+        :return: the observations, rewards, done flags and the info dicts of all the environments
+        """
+        self.step_async(actions)
+        workers = sorted(self._pending)
+        infos = []
+        for worker in workers:
+            infos.extend(self._receive(worker))
+        self._pending.clear()
+        return self.observations.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+    def close(self, terminate=False):
+        if self.closed:
+            return
+        self.closed = True
+        if not terminate:
+            # let the workers finish their step before asking them to close
+            for worker, pipe in enumerate(self.pipes):
+                try:
+                    if worker in self._pending:
+                        pipe.recv()
+                    pipe.send(('close', None))
+                    pipe.recv()
+                except (BrokenPipeError, EOFError):
+                    # the worker is gone already
+                    pass
+            self._pending.clear()
+        for process in self.processes:
+            if terminate:
+                process.terminate()
+            process.join()
+        for pipe in self.pipes:
+            pipe.close()
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            self.close(terminate=True)